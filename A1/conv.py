@@ -0,0 +1,182 @@
+import argparse
+import time
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+
+from helper import load_data, load_model, activations, forward_propagation, accuracy, time_it
+
+parser = argparse.ArgumentParser(description='Throughput of the im2col convolution layers')
+parser.add_argument("--conv", type=str, default="8,16", help="a comma separated list of conv layer filter counts")
+
+parser.add_argument("--sizes", type=str, default="100,100", help="hidden layer sizes of the dense MLP to compare")
+
+parser.add_argument("--batch_size", type=int, default=100, help="batch size used by the benchmark")
+
+parser.add_argument("--repeat", type=int, default=10, help="number of timed runs")
+
+parser.add_argument("--models", type=str, default="",
+                    help="a comma separated list of models trained by finale.py (with and without --conv) to compare \
+                    on --val: accuracy, parameters and inference images/s")
+
+parser.add_argument("--val", type=str, help="path to the Validation dataset of the --models comparison")
+
+parser.add_argument("--activation", type=str, default="sigmoid",
+                    help="the activation function the --models were trained with - tanh/sigmoid")
+
+
+# Images (N, C, H, W) -> rows (N * out_h * out_w, C * kh * kw), one row per receptive field
+def im2col(x, kh, kw, pad, stride):
+    N, C, H, W = x.shape
+    x = np.pad(x, ((0, 0), (0, 0), (pad, pad), (pad, pad)), mode='constant')
+    out_h = (H + 2 * pad - kh) // stride + 1
+    out_w = (W + 2 * pad - kw) // stride + 1
+    sN, sC, sH, sW = x.strides
+    windows = as_strided(x, shape=(N, out_h, out_w, C, kh, kw),
+                         strides=(sN, sH * stride, sW * stride, sC, sH, sW))
+    cols = windows.reshape(N * out_h * out_w, C * kh * kw)
+    return cols, out_h, out_w
+
+
+# Inverse of im2col, overlapping receptive fields are summed. Loops over the kh * kw kernel offsets only.
+def col2im(cols, x_shape, kh, kw, pad, stride, out_h, out_w):
+    N, C, H, W = x_shape
+    cols = cols.reshape(N, out_h, out_w, C, kh, kw).transpose(0, 3, 4, 5, 1, 2)
+    x = np.zeros((N, C, H + 2 * pad, W + 2 * pad))
+    for i in range(kh):
+        for j in range(kw):
+            x[:, :, i:i + stride * out_h:stride, j:j + stride * out_w:stride] += cols[:, :, i, j]
+    return x[:, :, pad:pad + H, pad:pad + W]
+
+
+# W * X + b for W (F, C, kh, kw), b (F, 1)
+def conv_forward(A, W, b, pad=1, stride=1):
+    N = A.shape[0]
+    F, C, kh, kw = W.shape
+    cols, out_h, out_w = im2col(A, kh, kw, pad, stride)
+    Z = cols.dot(W.reshape(F, -1).T) + b.T
+    Z = Z.reshape(N, out_h, out_w, F).transpose(0, 3, 1, 2)
+    cache = (A.shape, cols, W, b, pad, stride, out_h, out_w)
+    return Z, cache
+
+
+# Same 1/m scaling of dW, db as linear_backward
+def conv_backward(dZ, cache):
+    A_shape, cols, W, b, pad, stride, out_h, out_w = cache
+    m = A_shape[0]
+    F, C, kh, kw = W.shape
+    dZ = dZ.transpose(0, 2, 3, 1).reshape(-1, F)
+
+    dW = 1. / m * dZ.T.dot(cols).reshape(W.shape)
+    db = 1. / m * np.sum(dZ, axis=0).reshape(F, 1)
+    dcols = dZ.dot(W.reshape(F, -1))
+    dA_prev = col2im(dcols, A_shape, kh, kw, pad, stride, out_h, out_w)
+
+    return dA_prev, dW, db
+
+
+# Non overlapping max pooling, odd borders are cropped
+def maxpool_forward(A, size=2):
+    N, C, H, W = A.shape
+    out_h, out_w = H // size, W // size
+    windows = A[:, :, :out_h * size, :out_w * size].reshape(N, C, out_h, size, out_w, size)
+    windows = windows.transpose(0, 1, 2, 4, 3, 5).reshape(N, C, out_h, out_w, size * size)
+    arg = windows.argmax(axis=-1)
+    P = np.take_along_axis(windows, arg[..., None], axis=-1)[..., 0]
+    cache = (A.shape, arg, size)
+    return P, cache
+
+
+# The gradient goes to the max of every window only
+def maxpool_backward(dP, cache):
+    A_shape, arg, size = cache
+    N, C, H, W = A_shape
+    out_h, out_w = H // size, W // size
+    dwindows = np.zeros((N, C, out_h, out_w, size * size))
+    np.put_along_axis(dwindows, arg[..., None], dP[..., None], axis=-1)
+    dwindows = dwindows.reshape(N, C, out_h, out_w, size, size).transpose(0, 1, 2, 4, 3, 5)
+    dA = np.zeros(A_shape)
+    dA[:, :, :out_h * size, :out_w * size] = dwindows.reshape(N, C, out_h * size, out_w * size)
+    return dA
+
+
+#Output shape (C, H, W) after a stack of conv (same padding) + 2x2 pool layers
+def conv_output_shape(input_shape, conv_sizes, pool=2):
+    C, H, W = input_shape
+    for F in conv_sizes:
+        C, H, W = F, H // pool, W // pool
+    return C, H, W
+
+
+#inference forward of a model saved by finale.py, conv units (4-D W) first, X is (784, m) columns,
+#the dense layers after them run through helper.forward_propagation
+def model_forward(X, parameters, activation):
+    A = X
+    n_conv = sum(1 for k, v in parameters.items() if k[0] == 'W' and v.ndim == 4)
+    for l in range(1, n_conv + 1):
+        if A.ndim == 2:
+            A = A.T.reshape(A.shape[1], 1, 28, 28)
+        Z, _ = conv_forward(A, parameters['W' + str(l)], parameters['b' + str(l)])
+        A, _ = maxpool_forward(activations[activation](Z)[0])
+    if A.ndim == 4:
+        A = A.reshape(A.shape[0], -1).T
+    dense = {k[0] + str(int(k[1:]) - n_conv): v for k, v in parameters.items() if int(k[1:]) > n_conv}
+    return forward_propagation(A, dense, activation)
+
+
+#validation accuracy, parameter count and inference speed of trained models side by side
+def compare_models(paths, val_path, activation, batch_size, repeat, chunk=1000):
+    val_x, val_y = load_data(val_path)
+    X = val_x.T
+    print("{:<30} {:>10} {:>12} {:>12}".format("model", "val acc", "parameters", "images/s"))
+    for path in paths:
+        parameters, _ = load_model(path)
+        probas = np.concatenate([model_forward(X[:, i:i + chunk], parameters, activation)
+                                 for i in range(0, X.shape[1], chunk)], axis=1)
+        seconds = time_it(lambda: model_forward(X[:, :batch_size], parameters, activation), repeat)
+        print("{:<30} {:>9.2f}% {:>12,} {:>12.0f}".format(path, accuracy(probas, val_y),
+                                                         sum(v.size for v in parameters.values()),
+                                                         batch_size / seconds))
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    conv_sizes = [int(n) for n in args.conv.split(',')]
+    sizes = [int(n) for n in args.sizes.split(',')]
+    rng = np.random.RandomState(1)
+    X = rng.rand(args.batch_size, 1, 28, 28)
+
+    conv_Ws = [rng.randn(F, C, 3, 3) * 0.1 for C, F in zip([1] + conv_sizes, conv_sizes)]
+
+    def conv_pass():
+        A, caches = X, []
+        for W in conv_Ws:
+            Z, conv_cache = conv_forward(A, W, np.zeros((W.shape[0], 1)))
+            A, pool_cache = maxpool_forward(np.maximum(0, Z))
+            caches.append((conv_cache, pool_cache, Z))
+        dA = np.ones(A.shape)
+        for conv_cache, pool_cache, Z in reversed(caches):
+            dZ = maxpool_backward(dA, pool_cache) * (Z > 0)
+            dA, dW, db = conv_backward(dZ, conv_cache)
+
+    Ws = [rng.randn(o, i) * 0.1 for i, o in zip([784] + sizes, sizes)]
+
+    def dense_pass():
+        A, As = X.reshape(args.batch_size, -1).T, []
+        for W in Ws:
+            As.append(A)
+            A = np.maximum(0, W.dot(A))
+        dA, dWs = np.ones(A.shape), []
+        for W, A in zip(reversed(Ws), reversed(As)):
+            dWs.append(dA.dot(A.T))
+            dA = W.T.dot(dA)
+
+    for name, fn in (("conv " + args.conv, conv_pass), ("dense " + args.sizes, dense_pass)):
+        fn()
+        start = time.time()
+        for _ in range(args.repeat):
+            fn()
+        seconds = (time.time() - start) / args.repeat
+        print("{}: forward + backward {:.0f} images/s".format(name, args.batch_size / seconds))
+
+    if args.models:
+        compare_models(args.models.split(','), args.val, args.activation, args.batch_size, args.repeat)
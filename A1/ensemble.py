@@ -0,0 +1,109 @@
+#Ensemble of saved models: members with the same layer shapes are stacked and evaluated with one np.matmul per layer
+import argparse
+import numpy as np
+
+from helper import load_data, load_model, forward_propagation, activations, accuracy, output, time_it
+
+parser = argparse.ArgumentParser(description='Ensemble prediction over saved FeedForward Neural Network models')
+parser.add_argument("--models", type=str,
+                    default="variables_final.pickle,variables_v1.5.pickle,variables_params.pickle",
+                    help="a comma separated list of pickled models to ensemble")
+
+parser.add_argument("--activation", type=str, default="sigmoid",
+                    help="the activation function the models were trained with - tanh/sigmoid")
+
+parser.add_argument("--val", type=str, help="path to the Validation dataset")
+
+parser.add_argument("--test", type=str, help="path to the Test dataset")
+
+parser.add_argument("--output", type=str, default="test_submission_ensemble.csv",
+                    help="file the ensemble test predictions are written to")
+
+parser.add_argument("--repeat", type=int, default=10, help="number of timed runs for the throughput report")
+
+
+#Grouping models with the same layer shapes, so each group can be stacked into 3-D tensors
+def group_models(models):
+    groups = {}
+    for parameters in models:
+        L = len(parameters) // 2
+        key = tuple(parameters['W' + str(l)].shape for l in range(1, L + 1))
+        groups.setdefault(key, []).append(parameters)
+    return list(groups.values())
+
+
+#Stacking W (M, out, in) and b (M, out, 1) of every member layer by layer. The first layer shares its input,
+#its weights are concatenated into one (M*out, in) matrix and b into (M*out, 1) so it is a single GEMM
+def stack_parameters(members):
+    L = len(members[0]) // 2
+    stacked = {'W1': np.concatenate([p['W1'] for p in members]),
+               'b1': np.concatenate([p['b1'] for p in members]),
+               'M': len(members), 'L': L}
+    for l in range(2, L + 1):
+        stacked['W' + str(l)] = np.stack([p['W' + str(l)] for p in members])
+        stacked['b' + str(l)] = np.stack([p['b' + str(l)] for p in members])
+    return stacked
+
+
+#softmax over the class axis of every member independently
+def batched_softmax(Z):
+    e_x = np.exp(Z - np.max(Z, axis=-2, keepdims=True))
+    return e_x / e_x.sum(axis=-2, keepdims=True)
+
+
+#forward propagation of all members of a group: one fused GEMM for the first layer, one batched matmul per later layer
+def batched_forward_propagation(X, stacked, activation):
+    # (M*out, in) @ (in, m), split back into (M, out, m)
+    Z = (stacked['W1'] @ X + stacked['b1']).reshape(stacked['M'], -1, X.shape[1])
+
+    for l in range(2, stacked['L'] + 1):
+        # (M, out, in) @ (M, in, m)
+        A, _ = activations[activation](Z)
+        Z = np.matmul(stacked['W' + str(l)], A) + stacked['b' + str(l)]
+
+    return batched_softmax(Z)
+
+
+#Average of the softmax outputs over all members, (n_y, m)
+def ensemble_predict(X, groups, activation):
+    total = 0
+    n_members = 0
+    for stacked in groups:
+        probas = batched_forward_propagation(X, stacked, activation)
+        total = total + probas.sum(axis=0)
+        n_members += probas.shape[0]
+    return total / n_members
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+
+    print("Loading Models...")
+    paths = args.models.split(',')
+    models = [load_model(path)[0] for path in paths]
+    groups = [stack_parameters(members) for members in group_models(models)]
+    print("{} models in {} architecture group(s)".format(len(models), len(groups)))
+
+    if args.val:
+        print("Loading Data...")
+        val_x, val_y = load_data(args.val)
+        X = val_x.T
+
+        for path, parameters in zip(paths, models):
+            probas = forward_propagation(X, parameters, args.activation)
+            print("{}: validation accuracy {:.3f}%".format(path, accuracy(probas, val_y)))
+        probas = ensemble_predict(X, groups, args.activation)
+        print("ensemble: validation accuracy {:.3f}%".format(accuracy(probas, val_y)))
+
+        single = time_it(lambda: forward_propagation(X, models[0], args.activation), args.repeat)
+        looped = time_it(lambda: [forward_propagation(X, p, args.activation) for p in models], args.repeat)
+        batched = time_it(lambda: ensemble_predict(X, groups, args.activation), args.repeat)
+        print("single model: {:.1f} ms, {:.0f} images/s".format(1000 * single, X.shape[1] / single))
+        print("looped ensemble: {:.1f} ms, {:.0f} images/s ({:.2f}x single)".format(
+            1000 * looped, X.shape[1] / looped, looped / single))
+        print("batched ensemble: {:.1f} ms, {:.0f} images/s ({:.2f}x single)".format(
+            1000 * batched, X.shape[1] / batched, batched / single))
+
+    if args.test:
+        test_x, _ = load_data(args.test, labelled=False)
+        output(ensemble_predict(test_x.T, groups, args.activation), args.output)
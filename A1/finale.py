@@ -4,9 +4,14 @@ import argparse
 import sys
 import copy
 import os
+import time
 import pickle
 import matplotlib.pyplot as plt
 import pdb
+from sparse import magnitude_masks, apply_masks, density, save_sparse_model
+from conv import conv_forward, conv_backward, maxpool_forward, maxpool_backward, conv_output_shape
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from datacache import load_csv
 
 parser = argparse.ArgumentParser(description='Trains the FeedForward Neural Network')
 parser.add_argument("--lr", type=float, help="initial learning rate for gradient descent based algorithms")
@@ -21,6 +26,10 @@ parser.add_argument("--num_hidden", type=int,
 
 parser.add_argument("--sizes", type=str, help="a comma separated list for the size of each hidden layer")
 
+parser.add_argument("--conv", type=str, default="",
+                    help="a comma separated list for the number of filters of each 3x3 convolution + 2x2 max pool\
+                     layer, placed before the hidden layers")
+
 parser.add_argument("--activation", type=str,
                     help="the choice of activation function - valid values are hyperbolicTangent/sigmoid")
 
@@ -30,7 +39,10 @@ parser.add_argument("--loss", type=str,
 parser.add_argument("--opt", type=str,
                     help="the optimization algorithm to be used:\
                      gd, momentum, nag, adam - you will be implementing \
-                     the mini-batch version of these algorithms")
+                     the mini-batch version of these algorithms, or lbfgs for large (or full) batches")
+
+parser.add_argument("--lbfgs_m", type=int, default=10,
+                    help="number of curvature pairs kept by the lbfgs optimizer")
 
 parser.add_argument("--batch_size", type=int,
                     help="the batch size to be used - valid values are 1 and multiples of 5")
@@ -53,10 +65,20 @@ parser.add_argument("--test", type=str, help="path to the Test dataset")
 
 parser.add_argument("--val", type=str, help="path to the Validation dataset")
 
+parser.add_argument("--sparsity", type=float, default=0.0,
+                    help="if above 0, magnitude prune every hidden weight matrix to this fraction of zeros after\
+                     training and fine-tune, the pruned model is saved in CSR (the output layer stays dense)")
+
+parser.add_argument("--prune_iters", type=int, default=3,
+                    help="number of prune and fine-tune rounds used to reach the target sparsity")
+
+parser.add_argument("--prune_epochs", type=int, default=2, help="fine-tuning epochs after every pruning round")
+
 print("Parsing Arguments...")
 
 args = parser.parse_args()
 args.sizes = tuple([int(n) for n in args.sizes.split(',')])
+args.conv = tuple([int(n) for n in args.conv.split(',')]) if args.conv else ()
 
 if len(args.sizes) != args.num_hidden:
     if len(args.sizes) > args.num_hidden:
@@ -78,12 +100,16 @@ else:
     print("Error: Unidentified Loss Metric.")
     sys.exit()
 
-if args.opt == "gd" or args.opt == "momentum" or args.opt == "nag" or args.opt == "adam":
+if args.opt == "gd" or args.opt == "momentum" or args.opt == "nag" or args.opt == "adam" or args.opt == "lbfgs":
     pass
 else:
     print("Error: Unidentified Optimization Algorithm")
     sys.exit()
 
+if args.opt == "lbfgs" and args.loss != "ce":
+    print("Error: lbfgs needs the cross entropy loss, its gradient is the one computed by backward_propagation.")
+    sys.exit()
+
 if args.batch_size == 1 or args.batch_size % 5 == 0:
     pass
 else:
@@ -96,16 +122,27 @@ else:
     print("Error: Unidentified value of Anneal parameter.")
     sys.exit()
 
+if 0.0 <= args.sparsity < 1.0:
+    pass
+else:
+    print("Error: Sparsity should be in [0, 1).")
+    sys.exit()
+
+if args.sparsity > 0 and args.conv:
+    print("Error: Pruning is only supported for networks without convolution layers.")
+    sys.exit()
+
+if args.sparsity > 0 and not args.save_dir:
+    print("Error: Pruning needs --save_dir, the pruned model is saved there after training.")
+    sys.exit()
+
 # Load Data
 print("Loading Data...")
-train = pd.read_csv(args.train)
-test = pd.read_csv(args.test)
-val = pd.read_csv(args.val)
-train_x = np.array(train.drop(columns=["id", "label"], axis=1))
-train_y = np.array(train["label"]).reshape(55000, 1)
-val_x = np.array(val.drop(columns=["id", "label"], axis=1))
-val_y = np.array(val["label"]).reshape(5000, 1)
-test_x = np.array(test.drop(columns=["id"], axis=1))
+train_x, train_y = load_csv(args.train)
+val_x, val_y = load_csv(args.val)
+test_x, _ = load_csv(args.test, label=None)
+train_y = train_y.reshape(55000, 1)
+val_y = val_y.reshape(5000, 1)
 
 print("Preparing Data... ")
 # Convert to One Hot Encoding
@@ -129,14 +166,21 @@ n_x = 784
 n_y = 10
 
 #Initialize the Parameters (W,b)
-def initialize_parameters(layer_dims):
+def initialize_parameters(layer_dims, conv_dims=()):
     np.random.seed(1234)
     parameters = {}
+    # convolution layers come first, W is (filters, channels, 3, 3)
+    channels = 1
+    for l, filters in enumerate(conv_dims, 1):
+        parameters['W' + str(l)] = np.random.randn(filters, channels, 3, 3) * np.sqrt(1 / (channels * 9))
+        parameters['b' + str(l)] = np.zeros((filters, 1))
+        channels = filters
+    offset = len(conv_dims)
     L = len(layer_dims)
     for l in range(1, L):
-        parameters['W' + str(l)] = np.random.randn(layer_dims[l], layer_dims[l - 1]) * \
+        parameters['W' + str(l + offset)] = np.random.randn(layer_dims[l], layer_dims[l - 1]) * \
                                    np.sqrt(1 / layer_dims[l - 1])   #Hilbert Initialization
-        parameters['b' + str(l)] = np.zeros((layer_dims[l], 1))
+        parameters['b' + str(l + offset)] = np.zeros((layer_dims[l], 1))
 
     return parameters
 
@@ -166,6 +210,9 @@ def tanh(Z):
     return A, cache
 
 
+activations = {"sigmoid": sigmoid, "tanh": tanh, "relu": relu}
+
+
 def sigmoid_backward(dA, cache):
     Z = cache
     s = 1 / (1 + np.exp(-Z))
@@ -212,6 +259,26 @@ def linear_activation_forward(A_prev, W, b, activation):
 
     return A, cache
 
+#Convolution Unit output: conv, activation and 2x2 max pool, images are (m, channels, height, width)
+def conv_activation_forward(A_prev, W, b, activation):
+    if A_prev.ndim == 2:
+        # columns of flattened square images coming from the input layer
+        side = int(np.sqrt(A_prev.shape[0] // W.shape[1]))
+        A_prev = A_prev.T.reshape(A_prev.shape[1], W.shape[1], side, side)
+    Z, conv_cache = conv_forward(A_prev, W, b)
+    A, activation_cache = activations[activation](Z)
+    A, pool_cache = maxpool_forward(A)
+
+    cache = ("conv", conv_cache, activation_cache, pool_cache)
+
+    return A, cache
+
+#feature maps (m, channels, height, width) to the (features, m) columns of the dense layers
+def flatten(A):
+    if A.ndim == 4:
+        return A.reshape(A.shape[0], -1).T
+    return A
+
 #forward propagation operation for every layer
 def forward_propagation(X, parameters, activation_back=args.activation):
     caches = []
@@ -220,16 +287,25 @@ def forward_propagation(X, parameters, activation_back=args.activation):
 
     for l in range(1, L):
         A_prev = A
-        A, cache = linear_activation_forward(A_prev, parameters['W' + str(l)], parameters['b' + str(l)],
-                                             activation=activation_back)
+        if parameters['W' + str(l)].ndim == 4:
+            A, cache = conv_activation_forward(A_prev, parameters['W' + str(l)], parameters['b' + str(l)],
+                                               activation=activation_back)
+        else:
+            A, cache = linear_activation_forward(flatten(A_prev), parameters['W' + str(l)],
+                                                 parameters['b' + str(l)], activation=activation_back)
         caches.append(cache)
 
-    AL, cache = linear_activation_forward(A, parameters['W' + str(L)], parameters['b' + str(L)],
+    AL, cache = linear_activation_forward(flatten(A), parameters['W' + str(L)], parameters['b' + str(L)],
                                           activation="softmax")
     caches.append(cache)
 
     return AL, caches
 
+#forward propagation over chunks of columns, for evaluating whole datasets without keeping every cache
+def forward_in_chunks(X, parameters, chunk=1000):
+    probas = [forward_propagation(X[:, i:i + chunk], parameters)[0] for i in range(0, X.shape[1], chunk)]
+    return np.concatenate(probas, axis=1)
+
 #Calculate loss
 def compute_loss(AL, Y):
     if args.loss == "ce":
@@ -276,7 +352,7 @@ def linear_activation_backward(dA, cache, activation):
         dA_prev, dW, db = linear_backward(dZ, linear_cache)
 
     elif activation == "tanh":
-        dZ = sigmoid_backward(dA, activation_cache)
+        dZ = dA * tanh_backward(dA, activation_cache)
         dA_prev, dW, db = linear_backward(dZ, linear_cache)
 
     elif activation == "softmax":
@@ -284,6 +360,23 @@ def linear_activation_backward(dA, cache, activation):
 
     return dA_prev, dW, db
 
+#Derivative of every convolution Unit
+def conv_activation_backward(dA, cache, activation):
+    _, conv_cache, activation_cache, pool_cache = cache
+    if dA.ndim == 2:
+        # gradient from a dense layer, back to the pooled feature map shape
+        dA = dA.T.reshape(pool_cache[1].shape)
+    dA = maxpool_backward(dA, pool_cache)
+
+    if activation == "relu":
+        dZ = relu_backward(dA, activation_cache)
+    elif activation == "sigmoid":
+        dZ = sigmoid_backward(dA, activation_cache)
+    elif activation == "tanh":
+        dZ = dA * tanh_backward(dA, activation_cache)
+
+    return conv_backward(dZ, conv_cache)
+
 #Derivative of every layer 
 def backward_propagation(AL, Y, caches, activation_back):
     grads = {}
@@ -297,8 +390,12 @@ def backward_propagation(AL, Y, caches, activation_back):
 
     for l in reversed(range(L - 1)):
         current_cache = caches[l]
-        dA_prev_temp, dW_temp, db_temp = \
-            linear_activation_backward(grads["dA" + str(l + 2)], current_cache, activation=activation_back)
+        if current_cache[0] == "conv":
+            dA_prev_temp, dW_temp, db_temp = \
+                conv_activation_backward(grads["dA" + str(l + 2)], current_cache, activation=activation_back)
+        else:
+            dA_prev_temp, dW_temp, db_temp = \
+                linear_activation_backward(grads["dA" + str(l + 2)], current_cache, activation=activation_back)
 
         grads["dA" + str(l + 1)] = dA_prev_temp
         grads["dW" + str(l + 1)] = dW_temp
@@ -308,13 +405,13 @@ def backward_propagation(AL, Y, caches, activation_back):
 
 #Compute Loss for cross entropy
 def compute_ce_loss(X, Y_onehot, parameters):
-    AL, caches = forward_propagation(X, parameters)
+    AL = forward_in_chunks(X, parameters)
     loss = compute_loss(AL, Y_onehot)
     return loss
 
 #Compute Loss for Squared Error
 def compute_sq_loss(X, Y_onehot, parameters):
-    AL, caches = forward_propagation(X, parameters)
+    AL = forward_in_chunks(X, parameters)
     loss = compute_loss(AL, Y_onehot)
     return loss
 
@@ -415,17 +512,103 @@ def adam_update(parameters, grads, m, v, t, learning_rate=args.lr,
 
 
 
+#Flatten all W/b into a single vector, in the order W1, b1, W2, b2, ...
+def flatten_parameters(parameters, prefix=""):
+    L = len(parameters) // 2 if prefix == "" else len([k for k in parameters if k.startswith("dW")])
+    vec = []
+    for l in range(L):
+        vec.append(parameters[prefix + "W" + str(l + 1)].ravel())
+        vec.append(parameters[prefix + "b" + str(l + 1)].ravel())
+    return np.concatenate(vec)
+
+
+def unflatten_parameters(vec, template):
+    L = len(template) // 2
+    parameters = {}
+    start = 0
+    for l in range(L):
+        for key in ("W" + str(l + 1), "b" + str(l + 1)):
+            size = template[key].size
+            parameters[key] = vec[start:start + size].reshape(template[key].shape)
+            start += size
+    return parameters
+
+
+#initialization for L-BFGS
+def initialize_lbfgs():
+    return {"s": [], "y": []}
+
+
+#Updation for L-BFGS: two loop recursion for the direction, backtracking (Armijo) line search for the step.
+#The trials of the line search run forward only, the backward runs once at the accepted point and its
+#forward/backward are kept in state["accepted"] for the next step on the same batch
+def lbfgs_update(parameters, grads, loss, X_batch, Y_batch, state, activation_back, batch=0, memory=args.lbfgs_m,
+                 c1=1e-4, max_backtracks=20):
+    x = flatten_parameters(parameters)
+    g = flatten_parameters(grads, prefix="d")
+
+    q = g.copy()
+    alphas = []
+    for s, y in reversed(list(zip(state["s"], state["y"]))):
+        rho = 1.0 / y.dot(s)
+        alpha = rho * s.dot(q)
+        q -= alpha * y
+        alphas.append((rho, alpha))
+    if state["s"]:
+        s, y = state["s"][-1], state["y"][-1]
+        q *= s.dot(y) / y.dot(y)
+    else:
+        # no curvature yet, scale the first steepest descent step
+        q *= min(1.0, 1.0 / (np.linalg.norm(g) + 1e-12))
+    for (s, y), (rho, alpha) in zip(zip(state["s"], state["y"]), reversed(alphas)):
+        beta = rho * y.dot(q)
+        q += s * (alpha - beta)
+    direction = -q
+
+    slope = g.dot(direction)
+    if slope >= 0:
+        # not a descent direction, drop the history and fall back to steepest descent
+        state = initialize_lbfgs()
+        direction = -g * min(1.0, 1.0 / (np.linalg.norm(g) + 1e-12))
+        slope = g.dot(direction)
+
+    step = 1.0
+    for _ in range(max_backtracks):
+        new_parameters = unflatten_parameters(x + step * direction, parameters)
+        AL, caches = forward_propagation(X_batch, new_parameters)
+        new_loss = compute_loss(AL, Y_batch) / X_batch.shape[1]
+        if new_loss <= loss + c1 * step * slope:
+            break
+        step *= 0.5
+    else:
+        state.pop("accepted", None)
+        return parameters, state
+
+    new_grads = backward_propagation(AL, Y_batch, caches, activation_back)
+    new_g = flatten_parameters(new_grads, prefix="d")
+    state["accepted"] = {"batch": batch, "parameters": new_parameters, "AL": AL, "caches": caches, "grads": new_grads}
+    s, y = step * direction, new_g - g
+    if s.dot(y) > 1e-10:
+        state["s"].append(s)
+        state["y"].append(y)
+        if len(state["s"]) > memory:
+            state["s"].pop(0)
+            state["y"].pop(0)
+    return new_parameters, state
+
+
 #compute Error
 def compute_error(AL, Y_Batch):
     y_corr = 1 * (np.multiply(AL, Y_Batch) >= 0.5)
     accu = 100 * np.sum(y_corr) / Y_Batch.shape[1]
     return 100 - accu
 #Saving the data Model
-def save_datamodel(layerdims, max_epoch, lr, train_val_losses, valdata_val_losses, pred_trains, pred_vals, parameters):
-    hyper_para = {"LD": layerdims, "epoch": max_epoch, "lrate": lr}
+def save_datamodel(layerdims, max_epoch, lr, train_val_losses, valdata_val_losses, pred_trains, pred_vals, parameters,
+                   file_name='variables_params.pickle'):
+    hyper_para = {"LD": layerdims, "conv": args.conv, "epoch": max_epoch, "lrate": lr}
     loss_pd = {"TL": train_val_losses, "VL": valdata_val_losses, "PT": pred_trains, "PV": pred_vals}
     datapara_hyp = (parameters, hyper_para, loss_pd)
-    with open('variables_params.pickle', 'wb') as f:
+    with open(file_name, 'wb') as f:
         pickle.dump(datapara_hyp, f)
 
 #loading the data Model
@@ -437,7 +620,7 @@ def load_Data_Model():
 #prediction Accuracy
 def predict(X, y, parameters, loss_type):
     m = X.shape[1]
-    probas, caches = forward_propagation(X, parameters)
+    probas = forward_in_chunks(X, parameters)
     p = 1 * (probas >= 0.5)
     y_predict = p.argmax(axis=0).reshape(1, m).T
     percentage_loss = np.sum(1 * np.equal(y_predict, y)) * 100 / m
@@ -448,22 +631,25 @@ def predict(X, y, parameters, loss_type):
 
 #Network Model
 def ffnetwork(X, Y, train_y, val_X, val_Y, layers_dims, num_iterations=2, print_cost=False,
-              batch_size=args.batch_size):
+              batch_size=args.batch_size, parameters=None, masks=None, tag=""):
     learning_rate = args.lr
     beta1, beta2, epsilon = 0.9, 0.999, 1e-8
     np.random.seed(1)
-    parameters = initialize_parameters(layers_dims)
-    if args.pretrained:
-        parameters=load_Data_Model()
+    if parameters is None:
+        parameters = initialize_parameters(layers_dims, args.conv)
+        if args.pretrained:
+            parameters=load_Data_Model()
     activation_back = args.activation
 
     if args.opt == "momentum":
         m = initialize_velocity(parameters)
 
     m, v = initialize_adam(parameters)
+    lbfgs_state = initialize_lbfgs()
     gamma = 0.9
 
-    log_file_path = args.expt_dir + "log_train.txt"
+    # tag keeps the log and the saved model of a pruning fine-tune apart from the dense training ones
+    log_file_path = args.expt_dir + "log_train{}.txt".format(tag)
     log_file_writer = open(log_file_path, 'w+')
 
     total_count = 0
@@ -477,6 +663,7 @@ def ffnetwork(X, Y, train_y, val_X, val_Y, layers_dims, num_iterations=2, print_
     grads = []
     valdata_val_loss = -1
 
+    start_time = time.time()
     i = 0
     while i < num_iterations:
         print("Running Epoch", i)
@@ -493,7 +680,15 @@ def ffnetwork(X, Y, train_y, val_X, val_Y, layers_dims, num_iterations=2, print_
 
             prev_AL = AL
             prev_caches = caches
-            AL, caches = forward_propagation(X_batch, parameters)
+            # full batch L-BFGS: the line search of the previous step evaluated this batch at these parameters
+            # already (masks change the parameters in place after the step, no reuse then)
+            accepted = lbfgs_state.get("accepted")
+            reuse = args.opt == "lbfgs" and masks is None and accepted is not None and accepted["batch"] == j \
+                and accepted["parameters"] is parameters
+            if reuse:
+                AL, caches = accepted["AL"], accepted["caches"]
+            else:
+                AL, caches = forward_propagation(X_batch, parameters)
 
             loss = compute_loss(AL, Y_batch)
             error = compute_error(AL, Y_batch)
@@ -502,7 +697,7 @@ def ffnetwork(X, Y, train_y, val_X, val_Y, layers_dims, num_iterations=2, print_
             batch_losses.append(error)
 
             prev_grads = grads
-            grads = backward_propagation(AL, Y_batch, caches, activation_back)
+            grads = accepted["grads"] if reuse else backward_propagation(AL, Y_batch, caches, activation_back)
 
             prev_parameters = parameters
             if args.opt == "gd":
@@ -512,10 +707,16 @@ def ffnetwork(X, Y, train_y, val_X, val_Y, layers_dims, num_iterations=2, print_
             elif args.opt == "nag":
                 parameters, m = nag_update(parameters, grads, m, gamma, learning_rate, AL, \
                                            Y_batch, caches, activation_back)
+            elif args.opt == "lbfgs":
+                parameters, lbfgs_state = lbfgs_update(parameters, grads, loss / batch_size, X_batch, Y_batch,
+                                                       lbfgs_state, activation_back, batch=j)
             else:
                 t += 1
                 parameters, m, v = adam_update(parameters, grads, m, v, t, learning_rate, beta1, beta2,
                                                epsilon)
+            # keep pruned weights at zero while fine-tuning
+            if masks is not None:
+                parameters = apply_masks(parameters, masks)
             if step % 100 == 0:
                 log_file_writer.write(
                     "Epoch: {}, Step: {}, Loss: {}, Error: {}, lr: {}\n".format(i, step, round(loss, 2),
@@ -543,7 +744,7 @@ def ffnetwork(X, Y, train_y, val_X, val_Y, layers_dims, num_iterations=2, print_
 
         if pred_val > save_targate:
             save_datamodel(layers_dims, i, learning_rate, train_val_losses, valdata_val_losses, pred_trains, pred_vals,
-                           parameters)
+                           parameters, 'variables_params{}.pickle'.format(tag))
             
 
         if i > 2 and args.anneal == "true" and prev_valdata_loss < valdata_val_loss:
@@ -551,6 +752,7 @@ def ffnetwork(X, Y, train_y, val_X, val_Y, layers_dims, num_iterations=2, print_
             parameters, v, s = copy.deepcopy(prev_parameters), copy.deepcopy(prev_v), copy.deepcopy(prev_s)
             if args.opt == "adams":
                 t = t - (X.shape[0] // batch_size)
+            lbfgs_state = initialize_lbfgs()
             print("Annealing changed learning rate from %f to %f" % (2 * args.lr, args.lr))
             continue
         else:
@@ -560,6 +762,11 @@ def ffnetwork(X, Y, train_y, val_X, val_Y, layers_dims, num_iterations=2, print_
             pred_vals.append(pred_val)
         print ("loss after iteration %i train : %f,val: %f" %(i, np.array(train_val_losses).mean()/55000,np.array(valdata_val_losses).mean()/5000))
         print ("predict after iteration %i train : %f,val: %f" %(i, pred_train,pred_val))
+        # wall clock against validation accuracy, for time-to-accuracy comparisons between optimizers
+        elapsed = time.time() - start_time
+        print ("time after iteration %i : %.1fs" %(i, elapsed))
+        log_file_writer.write("Epoch: {}, Time: {:.1f}s, Val Loss: {}, Val Accuracy: {}, opt: {}\n".format(
+            i, elapsed, round(valdata_val_loss, 2), round(pred_val, 2), args.opt))
 
         i = i + 1
 
@@ -569,7 +776,7 @@ def ffnetwork(X, Y, train_y, val_X, val_Y, layers_dims, num_iterations=2, print_
 
 def output(X, parameters, ve_no):
     m = X.shape[1]
-    probas, caches = forward_propagation(X, parameters)
+    probas = forward_in_chunks(X, parameters)
     p = 1 * (probas >= 0.5)
     y_predict = p.argmax(axis=0).reshape(1, m).T
 
@@ -582,7 +789,8 @@ def output(X, parameters, ve_no):
     print("Success")
 
 
-layers_dims = [n_x]
+# the first dense layer sees the flattened output of the convolution layers
+layers_dims = [int(np.prod(conv_output_shape((1, 28, 28), args.conv)))]
 args.sizes = list(args.sizes)
 for i in args.sizes:
     layers_dims.append(i)
@@ -591,6 +799,20 @@ layers_dims = tuple(layers_dims)
 
 parameters, train_val_losses, valdata_val_losses = ffnetwork(train_x, train_y_onehot, train_y, val_x, val_y,
                                                              layers_dims, num_iterations=300, print_cost=True)
+
+# Iterative magnitude pruning: raise the sparsity step by step and fine-tune with the pruned weights fixed at zero
+if args.sparsity > 0:
+    for k in range(1, args.prune_iters + 1):
+        sparsity = args.sparsity * k / args.prune_iters
+        masks = magnitude_masks(parameters, sparsity)
+        parameters = apply_masks(parameters, masks)
+        print("Pruning round {}: sparsity {:.3f}, layer densities {}".format(
+            k, sparsity, [round(float(density(parameters['W' + str(l + 1)])), 3) for l in range(len(masks))]))
+        parameters, train_val_losses, valdata_val_losses = ffnetwork(train_x, train_y_onehot, train_y, val_x, val_y,
+                                                                     layers_dims, num_iterations=args.prune_epochs,
+                                                                     print_cost=True, parameters=parameters,
+                                                                     masks=masks, tag="_prune{}".format(k))
+    save_sparse_model(layers_dims, args.sparsity, parameters, args.save_dir + "variables_pruned.pickle")
 # pred_test = predict(val_x.T, val_y, parameters, loss_type="Validation")
 output(test_x.T, parameters, 8)
 
@@ -0,0 +1,115 @@
+import os
+import sys
+import pickle
+import time
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from datacache import load_csv
+
+
+# Loading the data (same layout as train/val/test csv used by finale.py), through the shared binary cache
+def load_data(path, labelled=True):
+    x, y = load_csv(path, label="label" if labelled else None)
+    if labelled:
+        y = y.reshape(-1, 1)
+    return normalize(x), y
+
+
+# Normalizing data
+def normalize(x):
+    a = 0
+    b = 1
+    x_max = 255
+    x_min = np.amin(x)
+    return ((x - x_min) * (b - a)) / (x_max - x_min)
+
+
+#loading a saved data Model, either (parameters, hyper_para, loss_pd) or bare parameters
+def load_model(path):
+    with open(path, 'rb') as f:
+        model = pickle.load(f)
+    if isinstance(model, tuple):
+        return model[0], model[1]
+    return model, {}
+
+
+#Different ACtivation Functions
+def softmax(Z):
+    e_x = np.exp(Z - np.max(Z))
+    A = e_x / e_x.sum(axis=0)
+    cache = Z
+    return A, cache
+
+
+def sigmoid(Z):
+    A = 1 / (1 + np.exp(-Z))
+    cache = Z
+    return A, cache
+
+
+def relu(Z):
+    A = np.maximum(0, Z)
+    cache = Z
+    return A, cache
+
+
+def tanh(Z):
+    A = np.tanh(Z)
+    cache = Z
+    return A, cache
+
+
+activations = {"sigmoid": sigmoid, "tanh": tanh, "relu": relu, "softmax": softmax}
+
+
+# W.X+b operation
+def linear_forward(A, W, b):
+    Z = W.dot(A) + b
+    cache = (A, W, b)
+
+    return Z, cache
+
+
+#forward propagation operation for every layer, inference only
+def forward_propagation(X, parameters, activation):
+    A = X
+    L = len(parameters) // 2
+
+    for l in range(1, L):
+        Z, _ = linear_forward(A, parameters['W' + str(l)], parameters['b' + str(l)])
+        A, _ = activations[activation](Z)
+
+    Z, _ = linear_forward(A, parameters['W' + str(L)], parameters['b' + str(L)])
+    AL, _ = softmax(Z)
+
+    return AL
+
+
+#prediction Accuracy
+def accuracy(probas, y):
+    y_predict = probas.argmax(axis=0).reshape(-1, 1)
+    return np.sum(1 * np.equal(y_predict, y)) * 100 / y.shape[0]
+
+
+#writing the kaggle submission file
+def output(probas, file_name):
+    m = probas.shape[1]
+    y_predict = probas.argmax(axis=0).reshape(m, 1)
+
+    A = np.arange(m).reshape(m, 1)
+    tag = ['id', 'label']
+    C = np.concatenate((A, y_predict), axis=1)
+    p = pd.DataFrame(C, columns=tag)
+    p.to_csv(file_name, sep=',', encoding='utf-8', index=False)
+    print("Success")
+
+
+#average wall clock time of fn over repeat runs, after one warm up run
+def time_it(fn, repeat):
+    fn()
+    start = time.time()
+    for _ in range(repeat):
+        fn()
+    return (time.time() - start) / repeat
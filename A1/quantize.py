@@ -0,0 +1,162 @@
+import argparse
+import os
+import pickle
+import sys
+import numpy as np
+
+from helper import load_data, load_model, forward_propagation, activations, softmax, accuracy, output, time_it
+
+parser = argparse.ArgumentParser(description='Int8 post-training quantization of a FeedForward Neural Network model')
+parser.add_argument("--model", type=str, default="variables_final.pickle", help="pickled float model to quantize")
+
+parser.add_argument("--activation", type=str, default="sigmoid",
+                    help="the activation function the model was trained with - tanh/sigmoid")
+
+parser.add_argument("--granularity", type=str, default="row",
+                    help="weight scale granularity: one scale per layer[layer] or per output row[row]")
+
+parser.add_argument("--mode", type=str, default="int",
+                    help="quantized forward: int8 inputs with int32 accumulation[int] or dequantize on the fly[dequant]")
+
+parser.add_argument("--calib", type=int, default=1000, help="number of validation rows used for calibration")
+
+parser.add_argument("--val", type=str, help="path to the Validation dataset")
+
+parser.add_argument("--test", type=str, help="path to the Test dataset")
+
+parser.add_argument("--save", type=str, default="variables_int8.pickle", help="file the quantized model is saved to")
+
+parser.add_argument("--output", type=str, default="test_submission_int8.csv",
+                    help="file the quantized test predictions are written to")
+
+parser.add_argument("--repeat", type=int, default=10, help="number of timed runs for the throughput report")
+
+# largest reduction length for which a float32 GEMM of int8 values is still exact
+EXACT_FP32_K = 2 ** 24 // (127 * 127)
+
+
+#symmetric int8 quantization of a weight matrix, scale per layer or per output row
+def quantize_weights(W, granularity):
+    if granularity == "row":
+        w_max = np.max(np.abs(W), axis=1, keepdims=True)
+    else:
+        w_max = np.max(np.abs(W))
+    scale = np.maximum(w_max, 1e-12) / 127.
+    Wq = np.clip(np.round(W / scale), -127, 127).astype(np.int8)
+    return Wq, np.asarray(scale, dtype=np.float32)
+
+
+def quantize_activations(A, scale):
+    return np.clip(np.round(A / scale), -127, 127).astype(np.int8)
+
+
+#Calibration: per layer scale of the layer input, from the max seen on a validation sample
+def calibrate(X, parameters, activation):
+    scales = []
+    A = X
+    L = len(parameters) // 2
+    for l in range(1, L + 1):
+        scales.append(max(np.max(np.abs(A)), 1e-12) / 127.)
+        Z = parameters['W' + str(l)].dot(A) + parameters['b' + str(l)]
+        A, _ = activations[activation](Z)
+    return scales
+
+
+def quantize_model(parameters, input_scales, granularity):
+    qparameters = {}
+    L = len(parameters) // 2
+    for l in range(1, L + 1):
+        Wq, w_scale = quantize_weights(parameters['W' + str(l)], granularity)
+        qparameters['W' + str(l)] = Wq
+        qparameters['b' + str(l)] = parameters['b' + str(l)].astype(np.float32)
+        qparameters['sW' + str(l)] = w_scale
+        qparameters['sA' + str(l)] = np.float32(input_scales[l - 1])
+    return qparameters
+
+
+def save_quantized_model(qparameters, hyper_para, qinfo, file_name):
+    with open(file_name, 'wb') as f:
+        pickle.dump((qparameters, hyper_para, qinfo), f)
+
+
+def load_quantized_model(file_name):
+    with open(file_name, 'rb') as f:
+        qparameters, hyper_para, qinfo = pickle.load(f)
+    return qparameters, hyper_para, qinfo
+
+
+# W.X+b with int8 weights
+def quantized_linear_forward(A, Wq, w_scale, b, a_scale, mode):
+    if mode == "int":
+        Aq = quantize_activations(A, a_scale)
+        if Wq.shape[1] <= EXACT_FP32_K:
+            # int8 x int8 products summed in float32 are exact up to 2^24, so BLAS gives the int32 result
+            acc = Wq.astype(np.float32).dot(Aq.astype(np.float32))
+        else:
+            acc = Wq.astype(np.int32).dot(Aq.astype(np.int32))
+        Z = acc * (w_scale * a_scale) + b
+    else:
+        Z = (Wq.astype(np.float32) * w_scale).dot(A.astype(np.float32)) + b
+    return Z
+
+
+def quantized_forward_propagation(X, qparameters, activation, mode="int"):
+    A = X
+    L = len([k for k in qparameters if k.startswith('W')])
+
+    for l in range(1, L + 1):
+        Z = quantized_linear_forward(A, qparameters['W' + str(l)], qparameters['sW' + str(l)],
+                                     qparameters['b' + str(l)], qparameters['sA' + str(l)], mode)
+        if l == L:
+            A, _ = softmax(Z)
+        else:
+            A, _ = activations[activation](Z)
+
+    return A
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+
+    if args.granularity not in ("row", "layer"):
+        print("Error: Unidentified weight scale granularity.")
+        sys.exit()
+    if args.mode not in ("int", "dequant"):
+        print("Error: Unidentified quantized forward mode.")
+        sys.exit()
+    if not args.val:
+        print("Error: a Validation dataset is needed for calibration.")
+        sys.exit()
+
+    print("Loading Model and Data...")
+    parameters, hyper_para = load_model(args.model)
+    val_x, val_y = load_data(args.val)
+    X = val_x.T
+
+    print("Calibrating on {} validation rows...".format(args.calib))
+    rng = np.random.RandomState(1)
+    calib_idx = rng.permutation(X.shape[1])[:args.calib]
+    input_scales = calibrate(X[:, calib_idx], parameters, args.activation)
+    qparameters = quantize_model(parameters, input_scales, args.granularity)
+    qinfo = {"activation": args.activation, "granularity": args.granularity, "calib": args.calib}
+    save_quantized_model(qparameters, hyper_para, qinfo, args.save)
+
+    # accuracy vs throughput report against the float64 forward path
+    print("{:<10} {:>10} {:>12} {:>12}".format("path", "val acc %", "images/s", "size KB"))
+    float_size = sum(v.nbytes for v in parameters.values())
+    quant_size = sum(np.asarray(v).nbytes for v in qparameters.values())
+    runs = [("float64", lambda: forward_propagation(X, parameters, args.activation), float_size)]
+    for mode in ("int", "dequant"):
+        runs.append((mode, lambda mode=mode: quantized_forward_propagation(X, qparameters, args.activation, mode),
+                     quant_size))
+    for name, fn, size in runs:
+        acc = accuracy(fn(), val_y)
+        seconds = time_it(fn, args.repeat)
+        print("{:<10} {:>10.3f} {:>12.0f} {:>12.1f}".format(name, acc, X.shape[1] / seconds, size / 1024.))
+    print("weights {:.1f}x smaller, saved file {} is {:.1f} KB (float model {:.1f} KB)".format(
+        float_size / quant_size, args.save, os.path.getsize(args.save) / 1024.,
+        os.path.getsize(args.model) / 1024.))
+
+    if args.test:
+        test_x, _ = load_data(args.test, labelled=False)
+        output(quantized_forward_propagation(test_x.T, qparameters, args.activation, args.mode), args.output)
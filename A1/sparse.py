@@ -0,0 +1,144 @@
+import argparse
+import pickle
+import numpy as np
+from scipy import sparse
+
+from helper import load_data, activations, softmax, linear_forward, accuracy, output, time_it
+
+parser = argparse.ArgumentParser(description='Sparse inference for pruned FeedForward Neural Network models')
+parser.add_argument("--model", type=str, help="pickled pruned model saved by finale.py --sparsity")
+
+parser.add_argument("--activation", type=str, default="sigmoid",
+                    help="the activation function the model was trained with - tanh/sigmoid")
+
+parser.add_argument("--max_density", type=float, default=1.0,
+                    help="layers denser than this are run through dense BLAS instead of CSR")
+
+parser.add_argument("--val", type=str, help="path to the Validation dataset")
+
+parser.add_argument("--test", type=str, help="path to the Test dataset")
+
+parser.add_argument("--output", type=str, default="test_submission_sparse.csv",
+                    help="file the sparse model test predictions are written to")
+
+parser.add_argument("--bench", action='store_true', help="measure the CSR vs dense BLAS throughput crossover")
+
+parser.add_argument("--sizes", type=str, default="100,300,1000,2000",
+                    help="a comma separated list of hidden layer sizes to benchmark")
+
+parser.add_argument("--batch_size", type=int, default=1000, help="batch size used by the benchmark")
+
+parser.add_argument("--repeat", type=int, default=10, help="number of timed runs for every benchmark point")
+
+
+#Magnitude pruning: mask keeping all but the smallest sparsity fraction of |W|
+def magnitude_mask(W, sparsity):
+    k = int(sparsity * W.size)
+    if k == 0:
+        return np.ones(W.shape, dtype=bool)
+    threshold = np.partition(np.abs(W), k - 1, axis=None)[k - 1]
+    return np.abs(W) > threshold
+
+
+#masks for every hidden layer W, biases and the small output layer are kept dense
+def magnitude_masks(parameters, sparsity):
+    masks = {}
+    L = len(parameters) // 2
+    for l in range(1, L):
+        masks['W' + str(l)] = magnitude_mask(parameters['W' + str(l)], sparsity)
+    return masks
+
+
+def apply_masks(parameters, masks):
+    for key, mask in masks.items():
+        parameters[key] = parameters[key] * mask
+    return parameters
+
+
+def density(W):
+    if sparse.issparse(W):
+        return W.nnz / float(np.prod(W.shape))
+    return np.count_nonzero(W) / float(W.size)
+
+
+#Saving the pruned Model, every pruned W stored in CSR, the output layer stays dense
+def save_sparse_model(layerdims, sparsity, parameters, file_name):
+    sparse_parameters = {}
+    output_key = 'W' + str(len(parameters) // 2)
+    for key, value in parameters.items():
+        sparse_parameters[key] = sparse.csr_matrix(value) if key.startswith('W') and key != output_key else value
+    hyper_para = {"LD": layerdims, "sparsity": sparsity}
+    with open(file_name, 'wb') as f:
+        pickle.dump((sparse_parameters, hyper_para), f)
+
+
+#loading the pruned Model, layers above max_density go back to dense arrays
+def load_sparse_model(file_name, max_density=1.0):
+    with open(file_name, 'rb') as f:
+        parameters, hyper_para = pickle.load(f)
+    for key, value in parameters.items():
+        if sparse.issparse(value) and density(value) > max_density:
+            parameters[key] = value.toarray()
+    return parameters, hyper_para
+
+
+#forward propagation where every W may be CSR or dense
+def sparse_forward_propagation(X, parameters, activation):
+    A = np.ascontiguousarray(X)
+    L = len(parameters) // 2
+
+    for l in range(1, L + 1):
+        # csr_matrix.dot(ndarray) returns a dense ndarray, so the next layer sees a plain array
+        Z, _ = linear_forward(A, parameters['W' + str(l)], parameters['b' + str(l)])
+        if l == L:
+            A, _ = softmax(np.asarray(Z))
+        else:
+            A, _ = activations[activation](np.asarray(Z))
+
+    return A
+
+
+#Throughput of one W.A product, CSR against dense BLAS, for a range of sparsities
+def crossover_benchmark(sizes, batch_size, repeat):
+    rng = np.random.RandomState(1)
+    sparsities = [0.5, 0.7, 0.8, 0.9, 0.95, 0.98, 0.99]
+    print("{:>6} {:>9} {:>12} {:>12} {:>8}".format("size", "sparsity", "dense ms", "csr ms", "speedup"))
+    for n in sizes:
+        W = rng.randn(n, n)
+        A = rng.rand(n, batch_size)
+        dense_time = time_it(lambda: W.dot(A), repeat)
+        crossover = None
+        for s in sparsities:
+            W_csr = sparse.csr_matrix(W * magnitude_mask(W, s))
+            csr_time = time_it(lambda: W_csr.dot(A), repeat)
+            if crossover is None and csr_time < dense_time:
+                crossover = s
+            print("{:>6} {:>9.2f} {:>12.3f} {:>12.3f} {:>7.2f}x".format(n, s, 1000 * dense_time, 1000 * csr_time,
+                                                                        dense_time / csr_time))
+        print("size {}: CSR overtakes dense BLAS at sparsity {}".format(
+            n, crossover if crossover is not None else "> {}".format(sparsities[-1])))
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+
+    if args.bench:
+        crossover_benchmark([int(n) for n in args.sizes.split(',')], args.batch_size, args.repeat)
+
+    if args.model:
+        parameters, hyper_para = load_sparse_model(args.model, args.max_density)
+        L = len(parameters) // 2
+        for l in range(1, L + 1):
+            W = parameters['W' + str(l)]
+            print("layer {}: {} density {:.3f} ({})".format(l, W.shape, density(W),
+                                                           "csr" if sparse.issparse(W) else "dense"))
+        if args.val:
+            val_x, val_y = load_data(args.val)
+            X = val_x.T
+            probas = sparse_forward_propagation(X, parameters, args.activation)
+            seconds = time_it(lambda: sparse_forward_propagation(X, parameters, args.activation), args.repeat)
+            print("validation accuracy {:.3f}%, {:.0f} images/s".format(accuracy(probas, val_y),
+                                                                        X.shape[1] / seconds))
+        if args.test:
+            test_x, _ = load_data(args.test, labelled=False)
+            output(sparse_forward_propagation(test_x.T, parameters, args.activation), args.output)
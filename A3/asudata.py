@@ -1,47 +1,111 @@
+import os
+import sys
+import time
+import argparse
+import glob
+import json
 import numpy as np
-import pandas as pd
-from augutil import Hflip,Vflip,Rrot,Rtra
+from augutil import augment_chunk
 from multiprocessing import Pool
-from PIL import Image, ImageOps
-pool = Pool()
-
-def data_augmentation(i,train_x):
-
-
-    im_array=train_x[i][:784].reshape(28,28)
-    im_image=Image.fromarray(im_array.astype("uint8"))
-    out_1=pool.apply_async(Hflip, [im_image]) 
-    out_2=pool.apply_async(Vflip, [im_image]) 
-    out_3=pool.apply_async(Rrot, [im_image]) 
-    out_4=pool.apply_async(Rtra, [im_image]) 
-    out_H=out_1.get()
-    out_V=out_2.get()
-    out_R=out_3.get()
-    out_T=out_4.get()
-    oti_img=im_array.reshape(1,784)
-    
-    out_stack_new=np.vstack((oti_img,out_H,out_V,out_R,out_T))
-    out_label_new=np.vstack(([train_x[i][-1]]*5))
-    print(i)
-
-        
-
-    return out_stack_new,out_label_new
-
-    
-train = pd.read_csv("data/train.csv")
-train_x = np.array(train.drop("id", axis=1))
-
-for i in range(train_x.shape[0]):
-    out_stack_old,out_label_old=data_augmentation(i,train_x)
-    data_id = np.concatenate((out_stack_old,out_label_old), axis=1)
-    tag=list(train)[1:]
-    data_df = pd.DataFrame(data_id, columns=tag)
-
-    f= open('augment_data.csv', 'a')
-    if i ==0:
-        data_df.to_csv(f, sep=',', encoding='utf-8', index=False)
-    else:
-        data_df.to_csv(f, sep=',', encoding='utf-8', index=False,header=False)
-    f.close()
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from datacache import load_csv
+
+parser = argparse.ArgumentParser(description='Offline augmentation: original + Hflip, Vflip, Rrot, Rtra of every image')
+parser.add_argument("--train", type=str, default="data/train.csv", help="path to the Training dataset")
+parser.add_argument("--shard_dir", type=str, default="data/augment_shards", help="directory of the binary chunk shards")
+parser.add_argument("--output", type=str, default="data/augment_data.csv",
+                    help="augmented csv assembled from the shards, empty to keep the shards only")
+parser.add_argument("--chunk_size", type=int, default=5000, help="images per chunk")
+parser.add_argument("--nworkers", type=int, default=os.cpu_count(), help="number of worker processes")
+parser.add_argument("--seed", type=int, default=1, help="random seed, chunk k uses seed + k")
+
+# set in every worker by init_worker, mapped from the binary cache so workers share its pages
+train_x, train_y = None, None
+
+
+def init_worker(train_path):
+    """ Pool initializer, works with the fork, spawn and forkserver start methods """
+    global train_x, train_y
+    train_x, train_y = load_csv(train_path)
+
+
+def shard_path(shard_dir, k):
+    return os.path.join(shard_dir, 'shard-{:05d}.npz'.format(k))
+
+
+def shard_settings(args):
+    """ Everything a shard depends on, shards written with other settings are not reused """
+    stat = os.stat(args.train)
+    return {'train': os.path.abspath(args.train), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns,
+            'chunk_size': args.chunk_size, 'seed': args.seed}
+
+
+def check_manifest(shard_dir, settings):
+    """ Removes the shards of shard_dir when its manifest.json is missing or differs, then writes the new one """
+    manifest_path = os.path.join(shard_dir, 'manifest.json')
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            if json.load(f) == settings:
+                return
+    stale = glob.glob(os.path.join(shard_dir, 'shard-*.npz'))
+    if stale:
+        print('{} shards were built with other settings, rebuilding'.format(len(stale)))
+    for path in stale:
+        os.remove(path)
+    with open(manifest_path + '.tmp', 'w') as f:
+        json.dump(settings, f)
+    os.replace(manifest_path + '.tmp', manifest_path)
+
+
+def augment_task(task):
+    k, start, end, seed = task
+    pixels, labels = augment_chunk(train_x[start:end], train_y[start:end], seed + k)
+    return k, pixels, labels
+
+
+def write_shard(path, pixels, labels):
+    """ Single writer: shard written under a temporary name then renamed, a killed run never leaves a partial shard """
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        np.savez(f, pixels=pixels, labels=labels)
+    os.replace(tmp_path, path)
+
+
+def write_csv(shard_dir, n_chunks, output):
+    """ Buffered csv in the layout AugmentedDatasetFromCSV reads: 784 pixel columns then label """
+    tmp_path = output + '.tmp'
+    header = ['pixel' + str(i) for i in range(1, 785)] + ['label']
+    with open(tmp_path, 'w', buffering=1 << 20) as f:
+        f.write(','.join(header) + '\n')
+        for k in range(n_chunks):
+            shard = np.load(shard_path(shard_dir, k))
+            rows = np.concatenate((shard['pixels'], shard['labels'].reshape(-1, 1)), axis=1)
+            np.savetxt(f, rows, fmt='%d', delimiter=',')
+    os.replace(tmp_path, output)
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    train_x, train_y = load_csv(args.train)
+    os.makedirs(args.shard_dir, exist_ok=True)
+    check_manifest(args.shard_dir, shard_settings(args))
+
+    n_chunks = (len(train_x) + args.chunk_size - 1) // args.chunk_size
+    # restartable: chunks with a finished shard of the same settings are skipped
+    tasks = [(k, k * args.chunk_size, min((k + 1) * args.chunk_size, len(train_x)), args.seed)
+             for k in range(n_chunks) if not os.path.exists(shard_path(args.shard_dir, k))]
+    print('{} chunks, {} already done'.format(n_chunks, n_chunks - len(tasks)))
+
+    start_time = time.time()
+    done = 0
+    with Pool(args.nworkers, initializer=init_worker, initargs=(args.train,)) as pool:
+        for k, pixels, labels in pool.imap_unordered(augment_task, tasks):
+            write_shard(shard_path(args.shard_dir, k), pixels, labels)
+            done += len(labels) // 5
+            elapsed = time.time() - start_time
+            print('chunk {}: {} images done, {:.0f} images/sec'.format(k, done, done / elapsed))
+
+    if args.output:
+        write_csv(args.shard_dir, n_chunks, args.output)
+        print('wrote {} in {:.1f}s'.format(args.output, time.time() - start_time))
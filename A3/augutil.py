@@ -100,3 +100,56 @@ def Rtra(im_image):
     out_array=np.array(out).reshape(1,784)
     return out_array
 
+
+
+###### Vectorized versions on a chunk of images (N, 28, 28), same distributions as the PIL transforms above
+
+def hflip_chunk(images, rng):
+    flip = rng.random_sample(len(images)) < 0.5
+    return np.where(flip[:, None, None], images[:, :, ::-1], images)
+
+
+def vflip_chunk(images, rng):
+    flip = rng.random_sample(len(images)) < 0.5
+    return np.where(flip[:, None, None], images[:, ::-1, :], images)
+
+
+def rrot_chunk(images, rng):
+    rotate = rng.random_sample(len(images)) < 0.5
+    k = rng.randint(1, 3, len(images))
+    out = images.copy()
+    for quarter in (1, 2):
+        sel = rotate & (k == quarter)
+        out[sel] = np.rot90(images[sel], quarter, axes=(1, 2))
+    return out
+
+
+def rtra_chunk(images, rng, max_vshift=10, max_hshift=10):
+    N, H, W = images.shape
+    shift = rng.random_sample(N) < 0.5
+    hshift = rng.randint(-max_hshift, max_hshift, N) * shift
+    vshift = rng.randint(-max_vshift, max_vshift, N) * shift
+    # out[r, c] = in[r + vshift, c + hshift], 0 outside the image (as the PIL affine transform)
+    rows = np.arange(H)[None, :] + vshift[:, None]
+    cols = np.arange(W)[None, :] + hshift[:, None]
+    valid = ((rows >= 0) & (rows < H))[:, :, None] & ((cols >= 0) & (cols < W))[:, None, :]
+    out = images[np.arange(N)[:, None, None], np.clip(rows, 0, H - 1)[:, :, None], np.clip(cols, 0, W - 1)[:, None, :]]
+    return np.where(valid, out, 0).astype(images.dtype)
+
+
+def augment_chunk(pixels, labels, seed):
+    """
+    Original, Hflip, Vflip, Rrot and Rtra variants of every image, interleaved per image as asudata.py always wrote them
+    Args:
+        pixels (np arr): uint8 (N, 784)
+        labels (np arr): (N,)
+        seed (int): seed of this chunk, so a chunk is reproduced exactly when regenerated
+    Returns:
+        uint8 (5N, 784) pixels and (5N,) labels
+    """
+    rng = np.random.RandomState(seed)
+    images = pixels.reshape(-1, 28, 28)
+    variants = [images, hflip_chunk(images, rng), vflip_chunk(images, rng), rrot_chunk(images, rng),
+                rtra_chunk(images, rng)]
+    out = np.stack(variants, axis=1).reshape(-1, 784).astype(np.uint8)
+    return out, np.repeat(labels, len(variants))
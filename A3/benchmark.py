@@ -0,0 +1,106 @@
+import argparse
+import os
+import sys
+import time
+import torch
+import torch.nn as nn
+from torch.utils.data import DataLoader, TensorDataset
+import utils
+from model import models
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from datacache import load_csv
+
+parser = argparse.ArgumentParser(description='Parameter count, throughput and accuracy of the FashionMNIST networks')
+parser.add_argument("--models", type=str, default="1,2,3,4", help="a comma separated list of --model numbers")
+parser.add_argument("--batch_size", type=int, default=100, help="batch size used by the benchmark")
+parser.add_argument("--repeat", type=int, default=5, help="number of timed batches")
+parser.add_argument("--val", type=str, default="data/val.csv", help="path to the Validation dataset")
+parser.add_argument("--checkpoints", type=str, default="",
+                    help="comma separated model:path pairs of trained checkpoints, e.g. 1:saved-models/1-run-0.pth.tar")
+parser.add_argument("--nocuda", action='store_true', help="no cuda used")
+
+
+def count_parameters(net):
+    return sum(p.numel() for p in net.parameters())
+
+
+def images_per_sec(fn, batch_size, repeat):
+    """ One warm up batch, then the average over repeat batches """
+    fn()
+    start = time.time()
+    for _ in range(repeat):
+        fn()
+    return batch_size * repeat / (time.time() - start)
+
+
+def train_throughput(net, X, y, repeat):
+    net.train()
+    criterion = nn.CrossEntropyLoss()
+    optimizer = torch.optim.Adam(net.parameters(), lr=0.001)
+
+    def step():
+        optimizer.zero_grad()
+        criterion(net(X), y).backward()
+        optimizer.step()
+    return images_per_sec(step, X.size(0), repeat)
+
+
+def eval_throughput(net, X, repeat):
+    net.eval()
+
+    def step():
+        with torch.no_grad():
+            net(X)
+    return images_per_sec(step, X.size(0), repeat)
+
+
+def csv_loader(csv_path, batch_size, shuffle=False, label="label"):
+    """ DataLoader of uint8 (1, 28, 28) images and labels (images only if label is None) from the binary csv cache """
+    pixels, labels = load_csv(csv_path, label=label)
+    images = torch.from_numpy(pixels).view(-1, 1, 28, 28)
+    dataset = TensorDataset(images) if labels is None else TensorDataset(images, torch.from_numpy(labels))
+    return DataLoader(dataset, batch_size=batch_size, shuffle=shuffle)
+
+
+def evaluate(net, loader, cuda):
+    """ Validation accuracy in percent """
+    net.eval()
+    correct = 0
+    with torch.no_grad():
+        for X, y in loader:
+            if cuda:
+                X, y = X.cuda(), y.cuda()
+            correct += (net(utils.normalize_batch(X)).argmax(1) == y).sum().item()
+    return 100. * correct / len(loader.dataset)
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    cuda = not args.nocuda and torch.cuda.is_available()
+    checkpoints = dict(pair.split(':', 1) for pair in args.checkpoints.split(',') if pair)
+
+    val_loader = None
+    if checkpoints:
+        val_loader = csv_loader(args.val, args.batch_size)
+
+    torch.manual_seed(1)
+    X = torch.randn(args.batch_size, 1, 28, 28)
+    y = torch.randint(0, 10, (args.batch_size,))
+    if cuda:
+        X, y = X.cuda(), y.cuda()
+
+    print("{:>5} {:<24} {:>12} {:>9} {:>13} {:>12} {:>8}".format(
+        "model", "network", "parameters", "MB", "train img/s", "eval img/s", "val acc"))
+    for m in args.models.split(','):
+        net = models[int(m)]()
+        if cuda:
+            net = net.cuda()
+        n_params = count_parameters(net)
+        train_speed = train_throughput(net, X, y, args.repeat)
+        eval_speed = eval_throughput(net, X, args.repeat)
+        acc = ""
+        if m in checkpoints:
+            net.load_state_dict(torch.load(checkpoints[m], map_location='cpu')['state_dict'])
+            acc = "{:.2f}%".format(evaluate(net, val_loader, cuda))
+        print("{:>5} {:<24} {:>12,} {:>9.1f} {:>13.0f} {:>12.0f} {:>8}".format(
+            m, type(net).__name__, n_params, n_params * 4 / 2**20, train_speed, eval_speed, acc))
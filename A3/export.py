@@ -0,0 +1,148 @@
+import argparse
+import copy
+import os
+import time
+import numpy as np
+import pandas as pd
+import torch
+import torch.nn as nn
+import utils
+from model import models
+from lowrank import load_factorized
+from benchmark import csv_loader, evaluate
+
+parser = argparse.ArgumentParser(description='Freeze a trained network for inference and run batched predictions')
+parser.add_argument("--model", type=int, default=1, choices=sorted(models), help="network of the checkpoint, see train.py")
+parser.add_argument("--checkpoint", type=str, help="trained checkpoint saved by train.py or lowrank.py")
+parser.add_argument("--frozen", type=str, default="", help="where the frozen TorchScript module is saved")
+parser.add_argument("--compile", action='store_true', help="also benchmark torch.compile of the folded network")
+parser.add_argument("--bench", action='store_true', help="latency and throughput of eager vs folded vs TorchScript")
+parser.add_argument("--predict", type=str, default="", help="frozen module to run on --test, no checkpoint needed")
+parser.add_argument("--val", type=str, default="data/val.csv", help="path to the Validation dataset")
+parser.add_argument("--test", type=str, default="data/test.csv", help="path to the Test dataset")
+parser.add_argument("--output", type=str, default="pytorch_sub.csv", help="kaggle submission written by --predict")
+parser.add_argument("--batch_size", type=int, default=500, help="inference batch size")
+parser.add_argument("--repeat", type=int, default=10, help="number of timed batches")
+
+
+def fold_conv_bn(conv, bn):
+    """ Conv2d followed by eval BatchNorm2d as one Conv2d: w' = w * g / s, b' = (b - mean) * g / s + beta """
+    scale = bn.weight.data / torch.sqrt(bn.running_var + bn.eps)
+    fused = copy.deepcopy(conv)
+    bias = conv.bias.data if conv.bias is not None else torch.zeros_like(bn.running_mean)
+    fused.weight.data = conv.weight.data * scale[:, None, None, None]
+    fused.bias = nn.Parameter((bias - bn.running_mean) * scale + bn.bias.data)
+    return fused
+
+
+def fold_bn_linear(bn, linear):
+    """ eval BatchNorm1d followed by Linear as one Linear: W' = W * s, b' = b + W shift """
+    scale = bn.weight.data / torch.sqrt(bn.running_var + bn.eps)
+    shift = bn.bias.data - bn.running_mean * scale
+    fused = copy.deepcopy(linear)
+    fused.weight.data = linear.weight.data * scale[None, :]
+    fused.bias.data = linear.bias.data + linear.weight.data.mv(shift)
+    return fused
+
+
+def fold_sequential(layers):
+    """
+    Inference copy of an nn.Sequential: dropout removed, BatchNorm folded where it is exact
+    (Conv2d -> BatchNorm2d and BatchNorm1d -> Linear). A BatchNorm after a ReLU or pooling is kept as is.
+    """
+    folded = []
+    for layer in layers:
+        if isinstance(layer, (nn.Dropout, nn.Dropout2d)):
+            continue
+        if isinstance(layer, nn.BatchNorm2d) and folded and isinstance(folded[-1], nn.Conv2d):
+            folded[-1] = fold_conv_bn(folded[-1], layer)
+        elif isinstance(layer, nn.Linear) and folded and isinstance(folded[-1], nn.BatchNorm1d):
+            folded[-1] = fold_bn_linear(folded[-1], layer)
+        else:
+            folded.append(copy.deepcopy(layer))
+    return nn.Sequential(*folded)
+
+
+def freeze(net):
+    """ Eval copy of the network with folded features and classifier, channels last for the conv kernels """
+    net = copy.deepcopy(net).eval()
+    net.features = fold_sequential(net.features)
+    net.classifier = fold_sequential(net.classifier)
+    return net.to(memory_format=torch.channels_last)
+
+
+def script(net, batch_size):
+    """ Traced and frozen TorchScript module of a frozen network """
+    example = torch.randn(batch_size, 1, 28, 28).to(memory_format=torch.channels_last)
+    with torch.inference_mode():
+        traced = torch.jit.trace(net, example)
+    return torch.jit.freeze(traced)
+
+
+def timing(fn, X, repeat):
+    """ ms per batch of batch 1 and images/sec at the batch size of X, one warm up call each """
+    with torch.inference_mode():
+        x1 = X[:1].contiguous(memory_format=torch.channels_last)
+        fn(x1)
+        start = time.time()
+        for _ in range(repeat):
+            fn(x1)
+        latency = 1000. * (time.time() - start) / repeat
+        fn(X)
+        start = time.time()
+        for _ in range(repeat):
+            fn(X)
+        throughput = X.size(0) * repeat / (time.time() - start)
+    return latency, throughput
+
+
+def predict(module, loader):
+    """ Batched class predictions of a frozen module """
+    preds = []
+    with torch.inference_mode():
+        for X in loader:
+            X = X[0] if isinstance(X, (list, tuple)) else X
+            X = utils.normalize_batch(X).contiguous(memory_format=torch.channels_last)
+            preds.append(module(X).argmax(1))
+    return torch.cat(preds).numpy()
+
+
+def write_submission(preds, file_name):
+    df_out = pd.DataFrame({'id': np.arange(len(preds)), 'label': preds})
+    df_out.to_csv(file_name, sep=',', encoding='utf-8', index=False)
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+
+    if args.predict:
+        module = torch.jit.load(args.predict)
+        test_loader = csv_loader(args.test, args.batch_size, label=None)
+        start = time.time()
+        preds = predict(module, test_loader)
+        print("{} predictions in {:.2f}s".format(len(preds), time.time() - start))
+        write_submission(preds, args.output)
+
+    if args.checkpoint:
+        net = load_factorized(args.checkpoint, args.model).eval()
+        frozen = freeze(net)
+        scripted = script(frozen, args.batch_size)
+        if args.frozen:
+            torch.jit.save(scripted, args.frozen)
+            print("saved {} ({:.1f} MB)".format(args.frozen, os.path.getsize(args.frozen) / 2**20))
+
+        backends = [("eager", net), ("folded", frozen), ("torchscript", scripted)]
+        if args.compile:
+            backends.append(("compile", torch.compile(frozen)))
+
+        val_loader = csv_loader(args.val, args.batch_size)
+        X = utils.normalize_batch(next(iter(val_loader))[0])
+        print("{:<12} {:>10} {:>16} {:>12} {:>12}".format("backend", "val acc", "batch 1 ms", "images/s", "max |diff|"))
+        with torch.inference_mode():
+            reference = net(X)
+        for name, module in backends:
+            with torch.inference_mode():
+                diff = (module(X.contiguous(memory_format=torch.channels_last)) - reference).abs().max().item()
+            acc = evaluate(module, val_loader, False)
+            latency, throughput = timing(module, X, args.repeat) if args.bench else (float('nan'), float('nan'))
+            print("{:<12} {:>9.2f}% {:>16.2f} {:>12.0f} {:>12.2e}".format(name, acc, latency, throughput, diff))
@@ -1,57 +1,135 @@
-from torch.autograd import Variable
+import argparse
+import time
+import torch
 import numpy as np
+import utils
+from model import models
 
-def make_fooling_image(X, target_y, model):
+parser = argparse.ArgumentParser(description='One pixel attack robustness of a trained network on the validation set')
+parser.add_argument("--model", type=int, default=1, choices=sorted(models), help="network of the checkpoint, see train.py")
+parser.add_argument("--checkpoint", type=str, help="trained checkpoint saved by train.py or lowrank.py")
+parser.add_argument("--val", type=str, default="data/val.csv", help="path to the Validation dataset")
+parser.add_argument("--n_images", type=int, default=100, help="number of validation images attacked")
+parser.add_argument("--batch_size", type=int, default=10, help="images attacked together")
+parser.add_argument("--pixels", type=int, default=1, help="pixels the attack may change")
+parser.add_argument("--popsize", type=int, default=100, help="differential evolution population per image")
+parser.add_argument("--maxiter", type=int, default=30, help="differential evolution generations")
+parser.add_argument("--seed", type=int, default=1, help="random seed")
+parser.add_argument("--fooling", action='store_true',
+                    help="also time make_fooling_images on the same images, towards random other classes")
+
+def make_fooling_images(X, target_y, model, max_iter=500, learning_rate=1):
     """
-    Generate a fooling image that is close to X, but that the model classifies
-    as target_y.
+    Generate fooling images for a whole batch at once: every image is pushed towards its own target
+    class and stops being updated as soon as the model classifies it as that target.
 
     Inputs:
-    - X: Input image; Tensor of shape (1, 1, 28, 28)
-    - target_y: An integer in the range [0, 9)
+    - X: Input images; Tensor of shape (N, 1, 28, 28)
+    - target_y: LongTensor of shape (N,) with the target class of every image
     - model: A pretrained CNN
 
     Returns:
-    - X_fooling: An image that is close to X, but that tried to classifed as target_y
-    by the model.
+    - X_fooling: Images close to X, each tried to be classified as its target_y by the model
+    - fooled: BoolTensor of shape (N,), True where the model now predicts target_y
     """
-    # Initialize our fooling image to the input image, and wrap it in a Variable.
-    X_fooling = X.clone()
-    X_fooling_var = Variable(X_fooling, requires_grad=True)
+    # eval mode: every image of the batch is independent of the others, the caller gets its mode back
+    was_training = model.training
+    model.eval()
+    try:
+        X_fooling = X.clone()
+        target_y = target_y.to(X.device)
+        fooled = torch.zeros(X.size(0), dtype=torch.bool, device=X.device)
 
-    learning_rate = 1
+        # Train loop
+        for i in range(1, max_iter):
 
-    # Train loop
-    for i in range(1,500):
+            # Forward of the images that are not fooled yet only.
+            active = (~fooled).nonzero().view(-1)
+            X_active = X_fooling[active].requires_grad_(True)
+            scores = model(X_active)
 
-        # Forward.
-        scores = model(X_fooling_var)
+            # Mark the newly fooled images, break once all of them are.
+            done = scores.detach().argmax(dim=1) == target_y[active]
+            fooled[active[done]] = True
+            if bool(fooled.all()):
+                print("model fooled at iteration : " + str(i))
+                break
 
-        # Current max index.
-        index = scores.data.max(dim=1)
+            # Backward of the target scores, one pass for the whole batch.
+            target_score = scores.gather(1, target_y[active].view(-1, 1)).sum()
+            im_grad, = torch.autograd.grad(target_score, X_active)
 
-        # Break if we've fooled the model.
-        if index == target_y:
-            print("model fooled at iteration : "+str(i))
-            break
+            # Update the images still active with their own normalised gradient.
+            keep = ~done
+            # clamped so an image with a zero gradient stays put instead of turning NaN
+            norm = im_grad[keep].flatten(1).norm(dim=1).clamp_min(1e-12).view(-1, 1, 1, 1)
+            X_fooling[active[keep]] += learning_rate * (im_grad[keep] / norm)
+        else:
+            # the images updated by the last iteration are checked once more, fooled matches the returned images
+            active = (~fooled).nonzero().view(-1)
+            with torch.no_grad():
+                done = model(X_fooling[active]).argmax(dim=1) == target_y[active]
+            fooled[active[done]] = True
+    finally:
+        model.train(was_training)
 
-        target_score = scores[0, target_y]
+    return X_fooling, fooled
 
-        # Backward.
-        target_score.backward()
 
-        # Gradient for image.
-        im_grad = X_fooling_var.grad.data
+def make_fooling_image(X, target_y, model):
+    """
+    Generate a fooling image that is close to X, but that the model classifies
+    as target_y.
 
-        # Update our image with normalised gradient.
-        X_fooling_var.data += learning_rate * (im_grad / im_grad.norm())
+    Inputs:
+    - X: Input image; Tensor of shape (1, 1, 28, 28)
+    - target_y: An integer in the range [0, 9)
+    - model: A pretrained CNN
 
-        # Zero our image gradient.
-        X_fooling_var.grad.data.zero_()
+    Returns:
+    - X_fooling: An image that is close to X, but that tried to classifed as target_y
+    by the model.
+    """
+    X_fooling, _ = make_fooling_images(X, torch.full((X.size(0),), target_y, dtype=torch.long), model)
+    return X_fooling
 
 
+# valid range of a normalized image, see utils.normalize_batch
+PIXEL_MIN, PIXEL_MAX = (0. - 0.1307) / 0.3081, (1. - 0.1307) / 0.3081
 
-    return X_fooling
+
+def fgsm(model, X, y, eps):
+    """
+    Fast gradient sign examples: one step of eps along the sign of the loss gradient
+    Inputs:
+    - X: normalized images (N, 1, 28, 28)
+    - y: LongTensor (N,) labels
+    - eps: budget in pixel units ([0, 1] image scale)
+    """
+    return pgd(model, X, y, eps, eps, 1, random_start=False)
+
+
+def pgd(model, X, y, eps, alpha, steps, random_start=True):
+    """
+    Projected gradient descent examples in the L-inf ball of radius eps around X, steps of alpha
+    (both in pixel units), clipped to the valid pixel range. The model is left in the mode it was in.
+    """
+    was_training = model.training
+    model.eval()
+    try:
+        eps, alpha = eps / 0.3081, alpha / 0.3081
+        X_adv = X.detach().clone()
+        if random_start:
+            X_adv += torch.empty_like(X_adv).uniform_(-eps, eps)
+        for _ in range(steps):
+            X_adv.requires_grad_(True)
+            loss = torch.nn.functional.cross_entropy(model(X_adv).float(), y)
+            grad, = torch.autograd.grad(loss, X_adv)
+            X_adv = X_adv.detach() + alpha * grad.sign()
+            X_adv = torch.min(torch.max(X_adv, X - eps), X + eps).clamp(PIXEL_MIN, PIXEL_MAX)
+        return X_adv.detach()
+    finally:
+        model.train(was_training)
 
 
 ###############################################################################################################################################################
@@ -71,13 +149,135 @@ def perturb_image(xs, img):
     # Make sure to floor the members of xs as int types
     xs = xs.astype(int)
 
-    for x, img in zip(xs, imgs):
-        # Split x into an array of 5-tuples (perturbation pixels)
-        # i.e., [[x,y,], ...]
-        pixels = np.split(x, len(x) // 3)
-        for pixel in pixels:
-            # At each pixel's x,y position, assign its rgb value
-            x_pos, y_pos, *rgb = pixel
-            img[x_pos, y_pos] = rgb
+    # Split every x into (x, y, *rgb) perturbation pixels and write all of them with one
+    # advanced indexing assignment instead of a python loop over images and pixels
+    pixels = xs.reshape(len(xs), -1, 3)
+    n = np.arange(len(xs))[:, None]
+    imgs[n, pixels[:, :, 0], pixels[:, :, 1]] = pixels[:, :, 2:]
+
+    return imgs
+
+
+def perturb_images(xs, images):
+    """
+    Perturbed copies of a batch of images for a whole differential evolution population at once
+    Args:
+        xs (Tensor): (B, P, 3k) candidates, k pixels of (row, col, value) for every image
+        images (Tensor): (B, 1, 28, 28) uint8 images
+    Returns:
+        Tensor: (B, P, 1, 28, 28) uint8 images
+    """
+    B, P, D = xs.shape
+    xs = xs.view(B, P, D // 3, 3)
+    out = images.unsqueeze(1).expand(B, P, *images.shape[1:]).clone()
+    b = torch.arange(B, device=xs.device).view(B, 1, 1)
+    p = torch.arange(P, device=xs.device).view(1, P, 1)
+    out[b, p, 0, xs[..., 0].long(), xs[..., 1].long()] = xs[..., 2].round().to(out.dtype)
+    return out
+
+
+def one_pixel_attack(model, images, labels, pixels=1, popsize=100, maxiter=30, F=0.5):
+    """
+    Untargeted one pixel attack of a batch by differential evolution (DE/rand/1), the population of
+    every image is a tensor and each generation is one forward pass of B * popsize images.
+
+    Inputs:
+    - images: uint8 Tensor (B, 1, 28, 28)
+    - labels: LongTensor (B,) true classes
+    - pixels: number of pixels the attack may change
+
+    Returns:
+    - success: BoolTensor (B,), True where a perturbed image is misclassified
+    - adversarial: uint8 Tensor (B, 1, 28, 28), the best candidate of every image
+    - generations: LongTensor (B,), generation the attack succeeded at (maxiter if it did not)
+    """
+    was_training = model.training
+    model.eval()
+    try:
+        B, device = images.size(0), images.device
+        H, W = images.shape[2:]
+        upper = torch.tensor([H - 1, W - 1, 255.], device=device).repeat(pixels)
+
+        def fitness(xs):
+            # probability of the true class, the attack minimises it
+            candidates = perturb_images(xs, images).view(-1, *images.shape[1:])
+            with torch.inference_mode():
+                probs = torch.softmax(model(utils.normalize_batch(candidates)).float(), dim=1)
+            probs = probs.view(B, -1, probs.size(1))
+            return probs.gather(2, labels.view(B, 1, 1).expand(B, probs.size(1), 1))[..., 0], probs.argmax(2)
+
+        population = torch.minimum(torch.rand(B, popsize, 3 * pixels, device=device) * (upper + 1), upper)
+        scores, preds = fitness(population)
+        success = (preds != labels.view(B, 1)).any(1)
+        generations = torch.full((B,), maxiter, dtype=torch.long, device=device)
+        generations[success] = 0
+
+        for g in range(1, maxiter + 1):
+            if bool(success.all()):
+                break
+            # three distinct random members of the population for every member, other than the member itself
+            others = torch.rand(B, popsize, popsize - 1, device=device).argsort(dim=2)[..., :3]
+            r = others + (others >= torch.arange(popsize, device=device).view(1, popsize, 1)).long()
+            pick = lambda k: population.gather(1, r[..., k:k + 1].expand(B, popsize, 3 * pixels))
+            trial = (pick(0) + F * (pick(1) - pick(2))).clamp(min=0)
+            trial = torch.minimum(trial, upper)
+            trial_scores, trial_preds = fitness(trial)
+            # a trial replaces its parent if it lowers the true class probability or fools the model,
+            # images already fooled keep their population
+            better = ((trial_scores < scores) | (trial_preds != labels.view(B, 1))) & ~success.view(B, 1)
+            population = torch.where(better.unsqueeze(2), trial, population)
+            scores = torch.where(better, trial_scores, scores)
+            preds = torch.where(better, trial_preds, preds)
+            fooled = (trial_preds != labels.view(B, 1)).any(1) & ~success
+            generations[fooled] = g
+            success |= fooled
+
+        # misclassified candidates first, then the lowest true class probability
+        best = (scores + (preds == labels.view(B, 1)).float()).argmin(1)
+        adversarial = perturb_images(population[torch.arange(B), best].unsqueeze(1), images)[:, 0]
+        return success, adversarial, generations
+    finally:
+        model.train(was_training)
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    from lowrank import load_factorized
+    from benchmark import csv_loader
+    torch.manual_seed(args.seed)
+    net = load_factorized(args.checkpoint, args.model).eval()
+
+    seen, correct, fooled, generations = 0, 0, 0, 0
+    fooling_fooled, fooling_seconds = 0, 0.
+    start = time.time()
+    for X, y in csv_loader(args.val, args.batch_size):
+        X, y = X[:args.n_images - seen], y[:args.n_images - seen]
+        seen += len(y)
+        with torch.inference_mode():
+            right = net(utils.normalize_batch(X)).argmax(1) == y
+        # only images the model gets right can be fooled
+        if bool(right.any()):
+            success, _, gens = one_pixel_attack(net, X[right], y[right], args.pixels, args.popsize, args.maxiter)
+            correct += int(right.sum())
+            fooled += int(success.sum())
+            generations += int(gens[success].sum())
+            if args.fooling:
+                target_y = (y[right] + torch.randint(1, 10, y[right].size())) % 10
+                fooling_start = time.time()
+                _, done = make_fooling_images(utils.normalize_batch(X[right]), target_y, net)
+                fooling_seconds += time.time() - fooling_start
+                fooling_fooled += int(done.sum())
+        if seen >= args.n_images:
+            break
+    # the one pixel attack time only
+    elapsed = time.time() - start - fooling_seconds
 
-    return imgs
\ No newline at end of file
+    print("images: {}, clean accuracy: {:.2f}%".format(seen, 100. * correct / seen))
+    print("{}-pixel attack success: {:.2f}% of the correctly classified images ({} / {})".format(
+        args.pixels, 100. * fooled / max(correct, 1), fooled, correct))
+    print("accuracy under attack: {:.2f}%".format(100. * (correct - fooled) / seen))
+    print("mean generations to succeed: {:.1f}".format(generations / max(fooled, 1)))
+    print("time: {:.1f}s, {:.2f} images/s".format(elapsed, seen / elapsed))
+    if args.fooling:
+        print("fooling images: {} / {} fooled in {:.1f}s, {:.2f} images/s".format(
+            fooling_fooled, correct, fooling_seconds, correct / max(fooling_seconds, 1e-9)))
@@ -5,6 +5,7 @@ import cv2
 import os
 import torchvision.transforms as T
 import copy
+from utils import make_mosaic, save_mosaic
 
 def deprocess(img):
     transform = T.Compose([
@@ -31,6 +32,19 @@ def save_gradient_images(gradient, file_name):
     path_to_file = os.path.join('../GBPresults', file_name + '.jpg')
     cv2.imwrite(path_to_file, gradient)
 
+def save_gradient_mosaic(gradients, file_name, n_columns=10):
+    """
+        Exports the gradients of a whole batch as one mosaic image
+    Args:
+        gradients (np arr): Numpy array of the gradients with shape (N, 1, 28, 28)
+        file_name (str): File name to be exported
+    """
+    if not os.path.exists('../GBPresults'):
+        os.makedirs('../GBPresults')
+
+    mosaic = make_mosaic(gradients.reshape(-1, gradients.shape[-2], gradients.shape[-1]), n_columns)
+    save_mosaic(mosaic, os.path.join('../GBPresults', file_name), scale=4)
+
 def save_fooling_images(gradient, file_name):
     """
         Exports the original gradient image
@@ -50,25 +64,34 @@ def save_fooling_images(gradient, file_name):
 
 class GuidedBackprop():
     """
-       Produces gradients generated with guided back propagation from the given image
+       Produces gradients generated with guided back propagation for a whole batch of images.
+       The ReLU hooks are installed when the context is entered and removed when it exits, so the
+       model is left as it was and one engine serves any number of batches on any device:
+
+           with GuidedBackprop(model) as GBP:
+               grads = GBP.generate_gradients(images, target_classes)
     """
-    def __init__(self, model, processed_im, target_class):
+    def __init__(self, model):
         self.model = model
-        self.input_image = processed_im
-        self.target_class = target_class
-        self.gradients = None
+        self.handles = []
+        self.relus = []
+        self.was_training = model.training
+
+    def __enter__(self):
         # Put model in evaluation mode
+        self.was_training = self.model.training
         self.model.eval()
         self.update_relus()
-        self.hook_layers()
+        return self
 
-    def hook_layers(self):
-        def hook_function(module, grad_in, grad_out):
-            self.gradients = grad_in[0]
-
-        # Register hook to the first layer
-        first_layer = list(self.model.features._modules.items())[0][1]
-        first_layer.register_backward_hook(hook_function)
+    def __exit__(self, *exc):
+        for handle in self.handles:
+            handle.remove()
+        for module, inplace in self.relus:
+            module.inplace = inplace
+        self.handles, self.relus = [], []
+        self.model.train(self.was_training)
+        return False
 
     def update_relus(self):
         """
@@ -78,24 +101,29 @@ class GuidedBackprop():
             """
             If there is a negative gradient, changes it to zero
             """
-            if isinstance(module, ReLU):
-                return (torch.clamp(grad_in[0], min=0.0),)
+            return (torch.clamp(grad_in[0], min=0.0),)
         # Loop through layers, hook up ReLUs with relu_hook_function
-        for pos, module in self.model.features._modules.items():
+        for module in self.model.features.modules():
             if isinstance(module, ReLU):
-                module.register_backward_hook(relu_hook_function)
+                # full backward hooks cannot wrap an in place op, ReLU(inplace=True) is switched off meanwhile
+                self.relus.append((module, module.inplace))
+                module.inplace = False
+                self.handles.append(module.register_full_backward_hook(relu_hook_function))
 
-    def generate_gradients(self):
+    def generate_gradients(self, images, target_class):
+        """
+        Args:
+            images (Tensor): normalized batch (N, 1, 28, 28) on the device of the model
+            target_class (Tensor): (N,) class whose score is back propagated for every image
+        Returns:
+            np arr: (N, 1, 28, 28) guided gradients with respect to the images
+        """
+        X = images.detach().clone().requires_grad_(True)
         # Forward pass
-        model_output = self.model(self.input_image)
-        # Zero gradients
-        self.model.zero_grad()
-        # Target for backprop
-        one_hot_output = torch.FloatTensor(1, model_output.size()[-1]).zero_().cuda()
-        one_hot_output[0][self.target_class.cpu()[0]] = 1
-        # Backward pass
-        model_output.backward(gradient=one_hot_output)
-        # Convert Pytorch variable to numpy array
-        gradients_as_arr = self.gradients.data.cpu().numpy()[0]
-        return gradients_as_arr
-
+        model_output = self.model(X)
+        # Target for backprop, one backward pass for the whole batch
+        one_hot_output = torch.zeros_like(model_output)
+        one_hot_output.scatter_(1, target_class.to(X.device).view(-1, 1), 1)
+        gradients, = torch.autograd.grad(model_output, X, grad_outputs=one_hot_output)
+        # Convert Pytorch tensor to numpy array
+        return gradients.cpu().numpy()
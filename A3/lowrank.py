@@ -0,0 +1,126 @@
+import argparse
+import os
+import time
+import torch
+import torch.nn as nn
+import torch.optim as optim
+import utils
+from model import models
+from benchmark import csv_loader, evaluate, eval_throughput, count_parameters
+
+parser = argparse.ArgumentParser(description='Low rank SVD factorization of the large classifier Linear of a trained network')
+parser.add_argument("--model", type=int, default=1, choices=sorted(models), help="network of the checkpoint, see train.py")
+parser.add_argument("--checkpoint", type=str, help="trained checkpoint saved by train.py")
+parser.add_argument("--layer", type=int, default=-1,
+                    help="index in net.classifier of the Linear to factorize, default the largest one")
+parser.add_argument("--ranks", type=str, default="32,64,128,256", help="a comma separated list of ranks to try")
+parser.add_argument("--finetune_epochs", type=int, default=0, help="epochs of fine tuning after the factorization")
+parser.add_argument("--lr", type=float, default=0.0001, help="fine tuning learning rate")
+parser.add_argument("--train", type=str, default="data/train.csv", help="path to the Training dataset")
+parser.add_argument("--val", type=str, default="data/val.csv", help="path to the Validation dataset")
+parser.add_argument("--batch_size", type=int, default=100, help="batch size")
+parser.add_argument("--repeat", type=int, default=5, help="number of timed batches for the latency")
+parser.add_argument("--save_dir", type=str, default="saved-models/", help="directory of the factorized checkpoints")
+
+
+def largest_linear(net):
+    sizes = [(m.weight.numel(), i) for i, m in enumerate(net.classifier) if isinstance(m, nn.Linear)]
+    return max(sizes)[1]
+
+
+def low_rank_linear(linear, rank, svd=None):
+    """
+    Linear(in, out) as Linear(in, rank, bias=False) followed by Linear(rank, out): W = U S V^T is cut to the
+    rank largest singular values, sqrt(S) goes to both factors so they have the same scale for fine tuning
+    Args:
+        linear (nn.Linear): trained layer
+        rank (int): kept singular values
+        svd (tuple): U, S, Vh of linear.weight, computed when None so several ranks can share one SVD
+    """
+    if svd is None:
+        svd = torch.linalg.svd(linear.weight.data, full_matrices=False)
+    U, S, Vh = svd
+    root = S[:rank].sqrt()
+    first = nn.Linear(linear.in_features, rank, bias=False)
+    second = nn.Linear(rank, linear.out_features)
+    first.weight.data.copy_(Vh[:rank] * root[:, None])
+    second.weight.data.copy_(U[:, :rank] * root[None, :])
+    second.bias.data.copy_(linear.bias.data)
+    return nn.Sequential(first, second)
+
+
+def low_rank_shell(linear, rank):
+    """ Same layers as low_rank_linear without the SVD, for checkpoints whose state dict overwrites them """
+    return nn.Sequential(nn.Linear(linear.in_features, rank, bias=False), nn.Linear(rank, linear.out_features))
+
+
+def factorize(net, layer, rank, svd=None):
+    """ Replaces net.classifier[layer] in place, the state dict keys become classifier.<layer>.0/1 """
+    net.classifier[layer] = low_rank_linear(net.classifier[layer], rank, svd)
+    return net
+
+
+def load_factorized(path, model):
+    """ Network of a checkpoint saved by this script (or a plain train.py checkpoint) """
+    checkpoint = torch.load(path, map_location='cpu')
+    net = models[model]()
+    if 'rank' in checkpoint:
+        net.classifier[checkpoint['layer']] = low_rank_shell(net.classifier[checkpoint['layer']], checkpoint['rank'])
+    net.load_state_dict(checkpoint['state_dict'])
+    return net
+
+
+def finetune(net, loader, epochs, lr):
+    net.train()
+    criterion = nn.CrossEntropyLoss()
+    optimizer = optim.Adam(net.parameters(), lr=lr, weight_decay=0.0005)
+    for e in range(epochs):
+        for X, y in loader:
+            output = net(utils.normalize_batch(X))
+            loss = criterion(output, y)
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
+    return net
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    if not os.path.exists(args.save_dir):
+        os.mkdir(args.save_dir)
+    val_loader = csv_loader(args.val, args.batch_size)
+    train_loader = csv_loader(args.train, args.batch_size, shuffle=True) if args.finetune_epochs else None
+    checkpoint = torch.load(args.checkpoint, map_location='cpu')
+    X = torch.randn(args.batch_size, 1, 28, 28)
+
+    def report(name, net, path):
+        ms = 1000. * args.batch_size / eval_throughput(net, X, args.repeat)
+        print("{:>6} {:>12,} {:>10.1f} {:>9.2f}% {:>14.2f}".format(
+            name, count_parameters(net), os.path.getsize(path) / 2**20, evaluate(net, val_loader, False), ms))
+
+    net = models[args.model]()
+    net.load_state_dict(checkpoint['state_dict'])
+    layer = args.layer if args.layer >= 0 else largest_linear(net)
+    print("factorizing classifier[{}] {}".format(layer, net.classifier[layer]))
+    print("{:>6} {:>12} {:>10} {:>10} {:>14}".format("rank", "parameters", "ckpt MB", "val acc", "ms per batch"))
+    report("full", net, args.checkpoint)
+
+    start = time.time()
+    svd = torch.linalg.svd(net.classifier[layer].weight.data, full_matrices=False)
+    print("svd of {} in {:.1f}s".format(tuple(net.classifier[layer].weight.shape), time.time() - start))
+
+    for rank in [int(r) for r in args.ranks.split(',')]:
+        net = models[args.model]()
+        net.load_state_dict(checkpoint['state_dict'])
+        factorize(net, layer, rank, svd)
+        if args.finetune_epochs:
+            finetune(net, train_loader, args.finetune_epochs, args.lr)
+        path = os.path.join(args.save_dir, '{}-rank-{}.pth.tar'.format(args.model, rank))
+        torch.save({
+            'epoch': checkpoint.get('epoch', 0),
+            'state_dict': net.state_dict(),
+            'layer': layer,
+            'rank': rank,
+            'best_prec1': checkpoint.get('best_prec1', 0),
+        }, path)
+        report(str(rank), net, path)
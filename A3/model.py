@@ -40,7 +40,7 @@ class FashionMNISTNet(nn.Module):
 
     def forward(self, x):
         x = self.features(x)
-        x = x.view(-1, 256*25*25)
+        x = x.reshape(-1, 256*25*25)
         x = self.classifier(x)
         return x
 
@@ -76,6 +76,91 @@ class BasicFashionMNISTNet(nn.Module):
 
     def forward(self, x):
         x = self.features(x)
-        x = x.view(-1, 256*25*25)
+        x = x.reshape(-1, 256*25*25)
         x = self.classifier(x)
         return x
+
+
+
+class CompactFashionMNISTNet(nn.Module):
+
+    """ Best network with stride 2 pooling: 28 -> 14 -> 7 -> 3, the first Linear sees 3*3*256 features instead of 25*25*256"""
+
+    def __init__(self):
+        super().__init__()
+        self.features = nn.Sequential(
+            nn.Conv2d(1, 32, kernel_size=3,stride=1, padding=1),
+            nn.BatchNorm2d(32),
+            nn.ReLU(inplace=True),
+            nn.Conv2d(32, 64, kernel_size=3,stride=1, padding=1),
+            nn.ReLU(inplace=True),
+            nn.BatchNorm2d(64),
+            nn.MaxPool2d(kernel_size=2, stride=2),
+            nn.Dropout2d(0.4),
+            nn.Conv2d(64, 128, kernel_size=3,stride=1, padding=1),
+            nn.ReLU(inplace=True),
+            nn.BatchNorm2d(128),
+            nn.MaxPool2d(kernel_size=2, stride=2),
+            nn.Conv2d(128, 256, kernel_size=3,stride=1, padding=1),
+            nn.ReLU(inplace=True),
+            nn.Conv2d(256, 256, kernel_size=3,stride=1, padding=1),
+            nn.ReLU(inplace=True),
+            nn.MaxPool2d(kernel_size=2, stride=2),
+        )
+        self.classifier = nn.Sequential(
+            nn.Dropout(0.4),
+            nn.Linear(3 * 3 * 256, 1024),
+            nn.ELU(inplace=True),
+            nn.BatchNorm1d(1024),
+            nn.Dropout(0.4),
+            nn.Linear(1024, 10),
+        )
+
+    def forward(self, x):
+        x = self.features(x)
+        x = x.reshape(-1, 256*3*3)
+        x = self.classifier(x)
+        return x
+
+
+
+class GAPFashionMNISTNet(nn.Module):
+
+    """ Compact network with global average pooling in place of the large fully connected layers"""
+
+    def __init__(self):
+        super().__init__()
+        self.features = nn.Sequential(
+            nn.Conv2d(1, 32, kernel_size=3,stride=1, padding=1),
+            nn.BatchNorm2d(32),
+            nn.ReLU(inplace=True),
+            nn.Conv2d(32, 64, kernel_size=3,stride=1, padding=1),
+            nn.ReLU(inplace=True),
+            nn.BatchNorm2d(64),
+            nn.MaxPool2d(kernel_size=2, stride=2),
+            nn.Dropout2d(0.4),
+            nn.Conv2d(64, 128, kernel_size=3,stride=1, padding=1),
+            nn.ReLU(inplace=True),
+            nn.BatchNorm2d(128),
+            nn.MaxPool2d(kernel_size=2, stride=2),
+            nn.Conv2d(128, 256, kernel_size=3,stride=1, padding=1),
+            nn.ReLU(inplace=True),
+            nn.BatchNorm2d(256),
+            nn.Conv2d(256, 256, kernel_size=3,stride=1, padding=1),
+            nn.ReLU(inplace=True),
+            nn.AdaptiveAvgPool2d(1),
+        )
+        self.classifier = nn.Sequential(
+            nn.Dropout(0.4),
+            nn.Linear(256, 10),
+        )
+
+    def forward(self, x):
+        x = self.features(x)
+        x = x.reshape(-1, 256)
+        x = self.classifier(x)
+        return x
+
+
+# --model number -> network class
+models = {1: FashionMNISTNet, 2: BasicFashionMNISTNet, 3: CompactFashionMNISTNet, 4: GAPFashionMNISTNet}
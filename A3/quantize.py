@@ -0,0 +1,88 @@
+import argparse
+import copy
+import itertools
+import os
+import torch
+import torch.nn as nn
+from torch.ao.quantization import quantize_dynamic, get_default_qconfig_mapping
+from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+import utils
+from model import models
+from lowrank import load_factorized
+from benchmark import csv_loader, evaluate
+from export import fold_sequential, timing
+
+parser = argparse.ArgumentParser(description='int8 post training quantization of a trained network')
+parser.add_argument("--model", type=int, default=1, choices=sorted(models), help="network of the checkpoint, see train.py")
+parser.add_argument("--checkpoint", type=str, help="trained checkpoint saved by train.py or lowrank.py")
+parser.add_argument("--mode", type=str, default="all", choices=["dynamic", "static", "both", "all"], help="dynamic / static / both / all (all three, for the report)")
+parser.add_argument("--val", type=str, default="data/val.csv", help="path to the Validation dataset, also the calibration data")
+parser.add_argument("--calib_batches", type=int, default=10, help="validation batches seen by the static calibration")
+parser.add_argument("--batch_size", type=int, default=100, help="batch size")
+parser.add_argument("--repeat", type=int, default=5, help="number of timed batches")
+parser.add_argument("--save_dir", type=str, default="saved-models/",
+                    help="directory of the quantized TorchScript modules, they run with export.py --predict")
+
+
+def prepare(net):
+    """ Eval copy with dropout removed and the exactly foldable BatchNorms folded, as export.py does """
+    net = copy.deepcopy(net).eval()
+    net.features = fold_sequential(net.features)
+    net.classifier = fold_sequential(net.classifier)
+    return net
+
+
+def dynamic_linear(net):
+    """ int8 weights for every nn.Linear, activations quantized on the fly per batch """
+    return quantize_dynamic(net, {nn.Linear}, dtype=torch.qint8)
+
+
+def static_features(net, loader, batches, backend="x86"):
+    """
+    Static int8 conv stack: observers are inserted into net.features by FX, the scales come from
+    batches calibration batches, the classifier stays float (or dynamic, see dynamic_linear)
+    """
+    torch.backends.quantized.engine = backend
+    net = copy.deepcopy(net)
+    example = (torch.randn(1, 1, 28, 28),)
+    observed = prepare_fx(net.features, get_default_qconfig_mapping(backend), example)
+    with torch.inference_mode():
+        for X, _ in itertools.islice(loader, batches):
+            observed(utils.normalize_batch(X))
+    net.features = convert_fx(observed)
+    return net
+
+
+def script_module(net, batch_size):
+    """ The quantized modules are saved as TorchScript, whose loading needs no model code """
+    example = torch.randn(batch_size, 1, 28, 28)
+    with torch.inference_mode():
+        return torch.jit.freeze(torch.jit.trace(net, example))
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    if not os.path.exists(args.save_dir):
+        os.mkdir(args.save_dir)
+    modes = ["dynamic", "static", "both"] if args.mode == "all" else [args.mode]
+
+    val_loader = csv_loader(args.val, args.batch_size)
+    net = prepare(load_factorized(args.checkpoint, args.model))
+    X = utils.normalize_batch(next(iter(val_loader))[0])
+
+    variants = [("fp32", net)]
+    for mode in modes:
+        quantized = net
+        if mode in ("static", "both"):
+            quantized = static_features(quantized, val_loader, args.calib_batches)
+        if mode in ("dynamic", "both"):
+            quantized = dynamic_linear(quantized)
+        variants.append((mode, quantized))
+
+    print("{:<8} {:>10} {:>10} {:>12} {:>12}".format("variant", "val acc", "MB", "batch 1 ms", "images/s"))
+    for name, module in variants:
+        path = os.path.join(args.save_dir, '{}-{}.pt'.format(args.model, name))
+        torch.jit.save(script_module(module, args.batch_size), path)
+        latency, throughput = timing(module, X, args.repeat)
+        print("{:<8} {:>9.2f}% {:>10.1f} {:>12.2f} {:>12.0f}".format(
+            name, evaluate(module, val_loader, False), os.path.getsize(path) / 2**20, latency, throughput))
@@ -0,0 +1,66 @@
+import argparse
+import csv
+import os
+import signal
+import subprocess
+import sys
+import time
+
+parser = argparse.ArgumentParser(description='Strong scaling of train.py --world_size: same data and global batch, more processes',
+                                 epilog='other arguments are passed on to train.py')
+parser.add_argument("--world_sizes", type=str, default="1,2,4", help="comma separated numbers of processes")
+parser.add_argument("--model", type=int, default=1, help="network to train, see train.py")
+parser.add_argument("--nepochs", type=int, default=1, help="epochs of every run, the last one is reported")
+parser.add_argument("--batch_size", type=int, default=100, help="global batch size, split between the processes")
+parser.add_argument("--timeout", type=float, default=None,
+                    help="seconds a run may take, a hung run (e.g. mismatched collectives) fails instead of waiting")
+
+
+def run(world_size, args, train_args):
+    """ One train.py job, its rank processes are killed with it when it runs over args.timeout """
+    cmd = [sys.executable, 'train.py', '--world_size', str(world_size), '--model', str(args.model),
+           '--nepochs', str(args.nepochs), '--batch_size', str(args.batch_size)] + train_args
+    # own process group, so the ranks started by utils.launch are reached as well
+    proc = subprocess.Popen(cmd, start_new_session=True)
+    try:
+        code = proc.wait(args.timeout)
+    except subprocess.TimeoutExpired:
+        os.killpg(proc.pid, signal.SIGKILL)
+        proc.wait()
+        raise
+    if code:
+        raise subprocess.CalledProcessError(code, cmd)
+
+
+def runs(out_dir):
+    return set(os.listdir(out_dir)) if os.path.exists(out_dir) else set()
+
+
+def last_epoch(timings_csv):
+    """ Training seconds and images/sec of the last epoch logged by train.py """
+    with open(timings_csv) as f:
+        row = list(csv.DictReader(f))[-1]
+    return float(row['total']), float(row['images_per_sec'])
+
+
+if __name__ == '__main__':
+    args, train_args = parser.parse_known_args()
+    out_dir = 'logs/{}'.format(args.model)
+
+    results = []
+    for world_size in [int(n) for n in args.world_sizes.split(",")]:
+        before = runs(out_dir)
+        start = time.time()
+        run(world_size, args, train_args)
+        wall = time.time() - start
+        run_dir, = runs(out_dir) - before
+        seconds, images_per_sec = last_epoch(os.path.join(out_dir, run_dir, 'timings.csv'))
+        results.append((world_size, wall, seconds, images_per_sec))
+
+    # speedup and efficiency relative to the first (smallest) world size
+    base_size, _, _, base_rate = results[0]
+    print("{:>9} {:>10} {:>12} {:>12} {:>9} {:>11}".format("processes", "wall s", "epoch s", "images/s", "speedup", "efficiency"))
+    for world_size, wall, seconds, images_per_sec in results:
+        speedup = images_per_sec / base_rate
+        print("{:>9} {:>10.1f} {:>12.1f} {:>12.0f} {:>8.2f}x {:>10.0f}%".format(
+            world_size, wall, seconds, images_per_sec, speedup, 100. * speedup * base_size / world_size))
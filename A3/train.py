@@ -1,24 +1,32 @@
 import torch
 import torch.nn as nn
-import torchvision.transforms as transforms
-from torch.autograd import Variable
 import torch.optim as optim
 from torch.utils.data import DataLoader
 import utils
 import time
 import argparse
 import os
+import math
 import pandas as pd
 import numpy as np
 from PIL import Image
 from pdb import set_trace as bp
-from guided import GuidedBackprop ,save_gradient_images,save_fooling_images
-from fooling import make_fooling_image
+from guided import GuidedBackprop, save_gradient_mosaic, save_fooling_images
+from fooling import make_fooling_images, fgsm, pgd
 from utils import plotNNFilter
-from model import FashionMNISTNet,BasicFashionMNISTNet
+from augutil import hflip_chunk, vflip_chunk, rrot_chunk, rtra_chunk
+from model import models
+from lowrank import low_rank_shell, load_factorized
+import sys
+import hashlib
+import torch.nn.functional as F
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from datacache import load_csv, save_atomic
 
 parser = argparse.ArgumentParser()
-parser.add_argument("--model", type=int, default=1, help="default 1 is BEST Model 2 is BASE Model ")
+parser.add_argument("--model", type=int, default=1, choices=sorted(models), help="default 1 is BEST Model 2 is BASE Model 3 is Stride 2 pooling Model 4 is Global Average Pooling Model ")
 parser.add_argument("--lr", type=float, default=0.001, help="default Learning Rate .001 ")
 parser.add_argument("--patience", type=int, default=5, help="early stopping patience")
 parser.add_argument("--batch_size", type=int, default=100, help="batch size")
@@ -27,54 +35,113 @@ parser.add_argument("--init", type=int, default=1, help="Custom Initializer : 1
 parser.add_argument("--resume", type=str, default="", help="Saved data Location")
 parser.add_argument("--nocuda", action='store_true', help="no cuda used")
 parser.add_argument("--aug", type=bool, default=False, help="use augmented data")
+parser.add_argument("--stream_aug", action='store_true',
+                    help="generate the augmented data on the fly from data/train.csv instead of reading augment_data.csv")
 parser.add_argument("--nworkers", type=int, default=4, help="number of workers")
 parser.add_argument("--seed", type=int, default=1, help="random seed")
+parser.add_argument("--distill", type=str, default="", help="teacher checkpoint, trains --model as a student on its logits")
+parser.add_argument("--teacher_model", type=int, default=1, choices=sorted(models), help="network of the teacher checkpoint")
+parser.add_argument("--temperature", type=float, default=4., help="distillation softmax temperature")
+parser.add_argument("--alpha", type=float, default=0.9, help="weight of the soft teacher loss, 1 - alpha for the labels")
+parser.add_argument("--checkpoint_every", type=int, default=0,
+                    help="also checkpoint every n training batches, --resume continues from that batch (0: epochs only)")
+parser.add_argument("--adv", type=str, default="", choices=["", "fgsm", "pgd"], help="adversarial training: fgsm or pgd")
+parser.add_argument("--adv_eps", type=float, default=0.1, help="adversarial budget, L-inf in [0, 1] pixel units")
+parser.add_argument("--pgd_steps", type=int, default=3, help="pgd steps per batch")
+parser.add_argument("--pgd_alpha", type=float, default=0.04, help="pgd step size in pixel units")
+parser.add_argument("--adv_fraction", type=float, default=1.0,
+                    help="fraction of the batches trained on their adversarial examples as well as the clean ones")
+parser.add_argument("--adv_weight", type=float, default=0.5,
+                    help="weight of the adversarial loss, (1 - weight) * clean loss + weight * adversarial loss")
+parser.add_argument("--keep_checkpoints", type=int, default=3, help="number of most recent epoch checkpoints kept on disk")
+parser.add_argument("--precision", type=str, default="fp32", choices=["fp32", "bf16"],
+                    help="bf16 runs forward passes under autocast, BatchNorm stays fp32")
+parser.add_argument("--instrument", action='store_true',
+                    help="per worker loader throughput and exact (cuda synchronized) stage timings in the run log folder")
+parser.add_argument("--profile_steps", type=str, default="",
+                    help="start,end: torch.profiler trace of training batches start to end - 1 of the first epoch, e.g. 10,20 "
+                         "(start >= 1, batch start - 1 warms the profiler up)")
+parser.add_argument("--bench_loader", action='store_true', help="measure train loader images/sec before training")
+parser.add_argument("--world_size", type=int, default=1,
+                    help="number of training processes (DistributedDataParallel, gloo), batch_size is split between them")
+parser.add_argument("--nnodes", type=int, default=1, help="number of machines of a --world_size run")
+parser.add_argument("--node_rank", type=int, default=0, help="index of this machine, 0 holds the rendezvous")
+parser.add_argument("--master_addr", type=str, default="127.0.0.1", help="address of node 0 for the rendezvous")
+parser.add_argument("--master_port", type=int, default=29500, help="port of the rendezvous on node 0")
 args = parser.parse_args()
+if args.distill and args.stream_aug:
+    # the cached teacher logits belong to fixed images, the streamed variants change every epoch
+    parser.error("--distill cannot be combined with --stream_aug, use --aug")
+if args.profile_steps:
+    first_step, last_step = [int(n) for n in args.profile_steps.split(",")]
+    if not 1 <= first_step < last_step:
+        parser.error("--profile_steps start,end needs 1 <= start < end")
 
 cuda = not args.nocuda and torch.cuda.is_available() # use cuda
-print('Training on cuda: {}'.format(cuda))
 
-# Set seeds. If using numpy this must be seeded too.
+# --world_size N: the script runs once per rank, started here or by torchrun (which sets RANK itself)
+if args.world_size > 1 and 'RANK' not in os.environ:
+    if args.world_size % args.nnodes:
+        parser.error("--world_size must be a multiple of --nnodes")
+    sys.exit(utils.launch(args.world_size, args.nnodes, args.node_rank, args.master_addr, args.master_port))
+rank = int(os.environ.get('RANK', 0))
+local_rank = int(os.environ.get('LOCAL_RANK', 0))
+world_size = int(os.environ.get('WORLD_SIZE', 1))
+if args.batch_size % world_size:
+    parser.error("--batch_size must be a multiple of the number of processes")
+if world_size > 1:
+    # env:// rendezvous at MASTER_ADDR:MASTER_PORT, the cores of the machine are shared by its processes
+    dist.init_process_group('gloo')
+    if cuda:
+        torch.cuda.set_device(local_rank)
+    else:
+        torch.set_num_threads(max(1, torch.get_num_threads() // int(os.environ.get('LOCAL_WORLD_SIZE', 1))))
+if rank == 0:
+    print('Training on cuda: {}, processes: {}'.format(cuda, world_size))
+
+# Set seeds. If using numpy this must be seeded too. Every rank draws its own augmentations.
+torch.manual_seed(args.seed + rank)
 if cuda:
-    torch.cuda.manual_seed_all(args.seed)
-
-# Setup folders for saved models and logs
-if not os.path.exists('saved-models/'):
-    os.mkdir('saved-models/')
-if not os.path.exists('logs/'):
-    os.mkdir('logs/')
-
-# a logs folder for each model and each run.
-out_dir = 'logs/{}'.format(args.model)
-if not os.path.exists(out_dir):
-    os.mkdir(out_dir)
-run = 0
-current_dir = '{}/run-{}'.format(out_dir, run)
-while os.path.exists(current_dir):
-	run += 1
-	current_dir = '{}/run-{}'.format(out_dir, run)
-os.mkdir(current_dir)
-logfile = open('{}/log.txt'.format(current_dir), 'w')
+    torch.cuda.manual_seed_all(args.seed + rank)
+
+# Setup folders for saved models and logs, only rank 0 of a --world_size run writes files
+if rank == 0:
+    if not os.path.exists('saved-models/'):
+        os.mkdir('saved-models/')
+    if not os.path.exists('logs/'):
+        os.mkdir('logs/')
+
+    # a logs folder for each model and each run.
+    out_dir = 'logs/{}'.format(args.model)
+    if not os.path.exists(out_dir):
+        os.mkdir(out_dir)
+    run = 0
+    current_dir = '{}/run-{}'.format(out_dir, run)
+    while os.path.exists(current_dir):
+        run += 1
+        current_dir = '{}/run-{}'.format(out_dir, run)
+    os.mkdir(current_dir)
+    logfile = open('{}/log.txt'.format(current_dir), 'w')
+else:
+    run, current_dir = None, None
+    logfile = open(os.devnull, 'w')
 print(args, file=logfile)
 
 fashion_names=['T-shirt/top','Trouser','Pullover','Dress','Coat','Sandal','Shirt','Sneaker','Bag','Ankle boot']
 
 
-# Define transforms.
-train_transforms = transforms.Compose([
-                        # transforms.RandomHorizontalFlip(),
-                        # utils.RandomRotation(),
-                        # utils.RandomTranslation(),
-                        # utils.RandomVerticalFlip(),
-                        utils.RandomErasing(),
-                        transforms.ToTensor(),
-                        transforms.Normalize((0.1307,), (0.3081,))
+# Define transforms. Datasets serve uint8 images, augmentation runs on the whole collated batch
+# and ToTensor/Normalize are done per batch by utils.normalize_batch
+train_transforms = None
+val_transforms = None
+batch_transforms = utils.BatchCompose([
+                        # utils.BatchRandomHorizontalFlip(),
+                        # utils.BatchRandomRotation(),
+                        # utils.BatchRandomTranslation(),
+                        # utils.BatchRandomVerticalFlip(),
+                        utils.BatchRandomErasing(),
                         ]
                         )
-val_transforms = transforms.Compose([
-                        transforms.ToTensor(),
-                        transforms.Normalize((0.1307,), (0.3081,))
-                        ])
 
 def weights_init(m):
     classname = m.__class__.__name__
@@ -94,100 +161,192 @@ def weights_init(m):
 ##																										 ##
 ###########################################################################################################
 
-class TrainDatasetFromCSV():
+def load_csv_images(csv_path, label="label", drop=("id",)):
+    """
+    Memory map the csv through the shared binary cache as a (N, 1, 28, 28) uint8 tensor and an int64 label tensor
+    Args:
+        csv_path (string): path to csv file
+        label (string): name of the label column, None for unlabelled data
+        drop (tuple): names of other non pixel columns
+    """
+    pixels, labels = load_csv(csv_path, label=label, drop=drop)
+    images = torch.from_numpy(pixels).view(-1, 1, 28, 28)
+    if labels is not None:
+        labels = torch.from_numpy(labels)
+    return images, labels
+
+
+class ImageDataset():
+    """ Serves zero-copy views of a preloaded uint8 image tensor """
+
+    def __init__(self, images, labels, transforms=None):
+        self.images = images
+        self.labels = labels
+        self.transforms = transforms
+
+    def transform(self, img):
+        # per image PIL transforms (augmentation) only, conversion to float is done per batch
+        if self.transforms is not None:
+            img_as_img = Image.fromarray(img[0].numpy())
+            img = torch.from_numpy(np.array(self.transforms(img_as_img), dtype=np.uint8)).view(1, 28, 28)
+        return img
+
+    def __getitem__(self, index):
+        img = self.transform(self.images[index])
+        if self.labels is None:
+            return img
+        # Return image and the label
+        return (img, self.labels[index])
+
+    def __len__(self):
+        return len(self.images)
+
+
+class TrainDatasetFromCSV(ImageDataset):
     def __init__(self, csv_path, height, width, transforms=None):
         """
         Args:
-            csv_path (string): path to csv file
+            csv_path (string): path to csv file with id, 784 pixels, label
             height (int): image height
             width (int): image width
-            transform: pytorch transforms for transforms and tensor conversion
+            transform: pytorch PIL transforms for augmentation
         """
-        self.data = pd.read_csv(csv_path)
-        self.labels = np.asarray(self.data.iloc[:, 785].values)
+        images, labels = load_csv_images(csv_path)
+        super().__init__(images, labels, transforms)
+        self.csv_path = csv_path
         self.height = height
         self.width = width
-        self.transforms = transforms
-    
-    def __getitem__(self, index):
-        single_image_label = self.labels[index]
 
-        img_as_np=np.array(self.data.iloc[index,1:785]).reshape(28,28)
-    
-        img_as_img = Image.fromarray(img_as_np.astype('uint8'))
-        img_as_img = img_as_img.convert()
-        # Transform image to tensor
-        if self.transforms is not None:
-            img_as_tensor = self.transforms(img_as_img)
-        # Return image and the label
-        return (img_as_tensor, single_image_label)
 
-    def __len__(self):
-        return len(self.data.index)
+class AugmentedDatasetFromCSV(ImageDataset):
+    def __init__(self, csv_path, height, width, transforms=None):
+        """
+        Args:
+            csv_path (string): path to csv file with 784 pixels, label
+            height (int): image height
+            width (int): image width
+            transform: pytorch PIL transforms for augmentation
+        """
+        images, labels = load_csv_images(csv_path, drop=())
+        super().__init__(images, labels, transforms)
+        self.csv_path = csv_path
+        self.height = height
+        self.width = width
 
 
+class StreamingAugmentedDatasetFromCSV(ImageDataset):
+    """
+    The augment_data.csv layout (original, Hflip, Vflip, Rrot, Rtra of every image, interleaved) generated lazily
+    from the base training images, so nothing is written to disk and every epoch sees fresh variants.
+    The variant at index i of epoch e is drawn from RandomState([seed, e, i]): a run is reproducible for any
+    number of workers or batch order, call set_epoch(e) before iterating the loader.
+    """
+    variants = [None, hflip_chunk, vflip_chunk, rrot_chunk, rtra_chunk]
 
-class AugmentedDatasetFromCSV():
-    def __init__(self, csv_path, height, width, transforms=None):
+    def __init__(self, csv_path, height, width, seed=1, transforms=None):
         """
         Args:
-            csv_path (string): path to csv file
+            csv_path (string): path to csv file with id, 784 pixels, label
             height (int): image height
             width (int): image width
-            transform: pytorch transforms for transforms and tensor conversion
+            seed (int): base seed of the variants
+            transform: pytorch PIL transforms for augmentation
         """
-        self.data = pd.read_csv(csv_path)
-        self.labels = np.asarray(self.data.iloc[:, 784].values)
+        images, labels = load_csv_images(csv_path)
+        super().__init__(images, labels, transforms)
+        self.csv_path = csv_path
         self.height = height
         self.width = width
-        self.transforms = transforms
-    
-    def __getitem__(self, index):
-        single_image_label = self.labels[index]
+        self.seed = seed
+        self.epoch = 0
+        # reseeding one generator is an order of magnitude cheaper than building a new one per image
+        self.rng = np.random.RandomState()
 
-        img_as_np=np.array(self.data.iloc[index,0:784]).reshape(28,28)
-    
-        img_as_img = Image.fromarray(img_as_np.astype('uint8'))
-        img_as_img = img_as_img.convert()
-        # Transform image to tensor
-        if self.transforms is not None:
-            img_as_tensor = self.transforms(img_as_img)
-        # Return image and the label
-        return (img_as_tensor, single_image_label)
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __getitem__(self, index):
+        base, variant = divmod(index, len(self.variants))
+        img = self.images[base]
+        if self.variants[variant] is not None:
+            self.rng.seed([self.seed, self.epoch, index])
+            # the chunk functions take (N, 28, 28), the channel axis of the (1, 28, 28) view is N = 1
+            img = torch.from_numpy(np.ascontiguousarray(self.variants[variant](img.numpy(), self.rng)))
+        return (self.transform(img), self.labels[base])
 
     def __len__(self):
-        return len(self.data.index)
+        return len(self.variants) * len(self.images)
 
-class TestDatasetFromCSV():
+
+class TestDatasetFromCSV(ImageDataset):
     def __init__(self, csv_path, height, width, transforms=None):
         """
         Args:
-            csv_path (string): path to csv file
+            csv_path (string): path to csv file with id, 784 pixels
             height (int): image height
             width (int): image width
-            transform: pytorch transforms for transforms and tensor conversion
+            transform: pytorch PIL transforms for augmentation
         """
-        self.data = pd.read_csv(csv_path)
+        images, _ = load_csv_images(csv_path, label=None)
+        super().__init__(images, None, transforms)
+        self.csv_path = csv_path
         self.height = height
         self.width = width
-        self.transforms = transforms
-    
-    def __getitem__(self, index):
-        img_as_np=np.array(self.data.iloc[index,1:785]).reshape(28,28)
-    
 
-        img_as_img = Image.fromarray(img_as_np.astype('uint8'))
-        img_as_img = img_as_img.convert()
-        # Transform image to tensor
-        if self.transforms is not None:
-            img_as_tensor = self.transforms(img_as_img)
-        return (img_as_tensor)
 
-    def __len__(self):
-        return len(self.data.index)
 
 
 
+class DistillDataset():
+    """ (image, label, teacher logits) triples: the teacher logits of a dataset are computed once and cached """
+
+    def __init__(self, dataset, logits):
+        self.dataset = dataset
+        self.logits = logits
+
+    def __getitem__(self, index):
+        img, label = self.dataset[index]
+        return (img, label, self.logits[index])
+
+    def __len__(self):
+        return len(self.dataset)
+
+
+def teacher_logits(teacher, dataset, checkpoint):
+    """
+    Teacher logits of every (un-augmented) image of dataset, saved next to the teacher checkpoint.
+    The cache is keyed by path, size and mtime of the checkpoint and of the dataset csv, as datacache.load_csv
+    keys its cache, so a new teacher or an edited training set recomputes it.
+    """
+    stat = os.stat(checkpoint)
+    csv_stat = os.stat(dataset.csv_path)
+    key = "{}|{}|{}|{}|{}|{}|{}".format(os.path.abspath(checkpoint), stat.st_size, stat.st_mtime_ns,
+                                        os.path.abspath(dataset.csv_path), csv_stat.st_size, csv_stat.st_mtime_ns,
+                                        len(dataset))
+    path = '{}.logits-{}.npy'.format(checkpoint, hashlib.sha1(key.encode("utf-8")).hexdigest()[:16])
+    if os.path.exists(path):
+        print("=> teacher logits from '{}'".format(path))
+        return torch.from_numpy(np.load(path))
+
+    teacher.eval()
+    loader = DataLoader(dataset, batch_size=args.batch_size, shuffle=False, num_workers=args.nworkers)
+    out_list = []
+    start = time.time()
+    with torch.inference_mode():
+        for X, _ in loader:
+            if cuda:
+                X = X.cuda()
+            out_list.append(teacher(utils.normalize_batch(X)).float().cpu())
+    logits = torch.cat(out_list)
+    save_atomic(path, logits.numpy())
+    print("=> teacher logits of {} images in {:.1f}s, saved to '{}'".format(len(logits), time.time() - start, path))
+    return logits
+
+
+def distill_loss(output, y, soft, T, alpha):
+    """ alpha * T^2 * KL(teacher || student) at temperature T + (1 - alpha) * cross entropy with the labels """
+    soft_loss = F.kl_div(F.log_softmax(output / T, dim=1), F.softmax(soft / T, dim=1), reduction='batchmean')
+    return alpha * T * T * soft_loss + (1. - alpha) * F.cross_entropy(output, y)
 
 
 # Create dataloaders. Use pin memory if cuda.
@@ -195,7 +354,10 @@ kwargs = {'pin_memory': True} if cuda else {}
 
 
 # if args.aug is True augmented data is used to train else Normal Data (as Augmented data creation is too much Time consuming we already generated the augmented data and saved it )
-if(args.aug):
+if(args.stream_aug):
+    trainset = StreamingAugmentedDatasetFromCSV('data/train.csv',28,28, seed=args.seed,
+                            transforms=train_transforms)
+elif(args.aug):
     trainset = AugmentedDatasetFromCSV('data/augment_data.csv',28,28,
                             transforms=train_transforms)
 else:
@@ -203,13 +365,31 @@ else:
                             transforms=train_transforms)
 
 
-train_loader = DataLoader(trainset, batch_size=args.batch_size,
-                        shuffle=True, num_workers=args.nworkers, **kwargs)
+def make_train_loader(dataset):
+    """
+    Shuffled through a ResumableSampler, and the worker seeds come from a private generator instead of
+    the global one, so a resumed run draws the same random numbers as an uninterrupted one.
+    With --world_size every rank loads its shard of the epoch in batches of batch_size / world_size.
+    """
+    if args.instrument:
+        dataset = utils.TimedDataset(dataset, args.nworkers)
+    sampler = utils.ResumableSampler(dataset, seed=args.seed, num_replicas=world_size, rank=rank)
+    generator = torch.Generator()
+    generator.manual_seed(args.seed + rank)
+    return DataLoader(dataset, batch_size=args.batch_size // world_size, sampler=sampler,
+                      num_workers=args.nworkers, generator=generator, **kwargs)
+
+
+train_loader = make_train_loader(trainset)
 valset = TrainDatasetFromCSV('data/val.csv',28,28, transforms=val_transforms)
 
 
-val_loader = DataLoader(valset, batch_size=args.batch_size,
-                        shuffle=False, num_workers=args.nworkers, **kwargs)
+# validation is split between the ranks as well, validate sums the shards. Strided slices rather than a
+# DistributedSampler, which pads the last shard and would count some images twice. The shards can differ
+# by a batch, validate runs the bare model and communicates only once at the end
+val_sampler = list(range(rank, len(valset), world_size))
+val_loader = DataLoader(valset, batch_size=args.batch_size // world_size, sampler=val_sampler,
+                        num_workers=args.nworkers, **kwargs)
 
 testset = TestDatasetFromCSV('data/test.csv',28,28, transforms=val_transforms)
 
@@ -229,65 +409,129 @@ test_loader = DataLoader(testset, batch_size=args.batch_size,
 
 
 
-def train(net, loader, criterion, optimizer):
-    net.train()
-    running_loss = 0
-    running_accuracy = 0
+def autocast():
+    """ bf16 autocast context of --precision bf16, a no-op for fp32 """
+    return torch.autocast(device_type='cuda' if cuda else 'cpu', dtype=torch.bfloat16,
+                          enabled=args.precision == 'bf16')
+
 
-    for i, (X,y) in enumerate(loader):
+def adversarial(net, X, y):
+    """ --adv examples of a normalized batch """
+    with autocast():
+        if args.adv == 'fgsm':
+            return fgsm(net, X, y, args.adv_eps)
+        return pgd(net, X, y, args.adv_eps, args.pgd_alpha, args.pgd_steps)
+
+
+def train(net, loader, criterion, optimizer, start_step=0, running=(0, 0), on_step=None, timings=None):
+    """
+    One epoch. start_step and running (loss and correct count so far) continue an epoch from a mid epoch
+    checkpoint, the sampler must skip the same batches. on_step(step, running) is called after every batch.
+    timings (dict) collects the seconds of every stage of the loop: data (waiting for the loader, copy to the
+    device, batch augmentation), adv (adversarial examples), forward (with the loss), backward, step, other.
+    A batch picked for --adv trains on (1 - adv_weight) * clean loss + adv_weight * adversarial loss.
+    """
+    timings = {} if timings is None else timings
+    net.train()
+    running_loss, running_accuracy = running
+    last = time.perf_counter()
+
+    def lap(stage):
+        # time since the previous lap goes to stage, cuda kernels are waited for with --instrument only
+        nonlocal last
+        if cuda and args.instrument:
+            torch.cuda.synchronize()
+        now = time.perf_counter()
+        timings[stage] = timings.get(stage, 0.) + now - last
+        last = now
+
+    def batch_loss(output, y, soft):
+        if soft is not None:
+            return distill_loss(output, y, soft, args.temperature, args.alpha)
+        return criterion(output, y)
+
+    for i, batch in enumerate(loader, start_step):
+        # DistillDataset batches carry the teacher logits as a third element
+        X, y = batch[0], batch[1]
+        soft = batch[2] if len(batch) == 3 else None
         if cuda:
             X, y = X.cuda(), y.cuda()
-        X, y = Variable(X), Variable(y)
+            soft = soft.cuda() if soft is not None else None
+        X = utils.normalize_batch(batch_transforms(X))
+        lap('data')
+        n = len(y)
+        if args.adv and float(torch.rand(1)) < args.adv_fraction:
+            # the bare network, a DDP forward without its backward would break the gradient sync
+            X_adv = adversarial(getattr(net, 'module', net), X, y)
+            # clean and adversarial examples share one forward pass
+            X = torch.cat((X, X_adv))
+            lap('adv')
         # bp()
-        output = net(X)
-        loss = criterion(output, y)
+        with autocast():
+            output = net(X).float()
+        loss = batch_loss(output[:n], y, soft)
+        if len(output) > n:
+            loss = (1. - args.adv_weight) * loss + args.adv_weight * batch_loss(output[n:], y, soft)
+        # the statistics are of the clean examples
+        output = output[:n]
+        lap('forward')
         optimizer.zero_grad()
         loss.backward()
+        lap('backward')
         optimizer.step()
-        running_loss += loss.data[0]
-        pred = output.data.max(1, keepdim=True)[1] # get the index of the max log-probability
-        running_accuracy += pred.eq(y.data.view_as(pred)).cpu().sum()
-    return running_loss/len(loader), running_accuracy/len(loader.dataset)
+        lap('step')
+        running_loss += loss.item()
+        pred = output.detach().max(1, keepdim=True)[1] # get the index of the max log-probability
+        running_accuracy += pred.eq(y.view_as(pred)).sum().item()
+        if on_step is not None:
+            on_step(i + 1, (running_loss, running_accuracy))
+        lap('other')
+    n_samples = loader.sampler.num_samples
+    running_loss, running_accuracy, n_batches, n_samples = utils.all_reduce_sum(
+        running_loss, running_accuracy, math.ceil(n_samples / loader.batch_size), n_samples)
+    return running_loss/n_batches, running_accuracy/n_samples
 
 def validate(net, loader, criterion):
     net.eval()
     running_loss = 0
     running_accuracy = 0
-    for i, (X,y) in enumerate(loader):
-        if cuda:
-            X, y = X.cuda(), y.cuda()
-        X, y = Variable(X, volatile=True), Variable(y)
-        output = net(X)
-        loss = criterion(output, y)
-        running_loss += loss.data[0]
-        pred = output.data.max(1, keepdim=True)[1] # get the index of the max log-probability
-        running_accuracy += pred.eq(y.data.view_as(pred)).cpu().sum()
-    return running_loss/len(loader), running_accuracy/len(loader.dataset)
+    with torch.inference_mode():
+        for i, (X,y) in enumerate(loader):
+            if cuda:
+                X, y = X.cuda(), y.cuda()
+            X = utils.normalize_batch(X)
+            with autocast():
+                output = net(X).float()
+            loss = criterion(output, y)
+            running_loss += loss.item() * len(y)
+            pred = output.max(1, keepdim=True)[1] # get the index of the max log-probability
+            running_accuracy += pred.eq(y.view_as(pred)).sum().item()
+    # the same totals on every rank, so they all take the same early stopping decisions
+    running_loss, running_accuracy, n_samples = utils.all_reduce_sum(
+        running_loss, running_accuracy, len(loader.sampler))
+    return running_loss/n_samples, running_accuracy/n_samples
 
 
 def predict(net, loader ):
     net.eval()
     out_list=[]
-    for i, (X) in enumerate(loader):
-        if cuda:
-            X= X.cuda()
-        X= Variable(X, volatile=True)
-        output = net(X)
-        pred = output.data.max(1, keepdim=True)[1] # get the index of the max log-probability
-        out_list.append(pred)
+    with torch.inference_mode():
+        for i, (X) in enumerate(loader):
+            if cuda:
+                X= X.cuda()
+            X = utils.normalize_batch(X)
+            output = net(X)
+            pred = output.max(1, keepdim=True)[1] # get the index of the max log-probability
+            out_list.append(pred.cpu())
     data_out(out_list)
 
 def data_out(out_list):
 
-
-    pred_list=[]
-    for i in out_list :
-        for j in i:
-            pred_list.append(int(str(j).split("\n")[1].lstrip().rstrip()))
+    pred_list=torch.cat(out_list).view(-1).numpy()
 
     tag = ['id', 'label']
-    ids = np.arange(10000).reshape(10000, 1)
-    list_pred=np.array(pred_list).reshape(10000,1)
+    ids = np.arange(len(pred_list)).reshape(-1, 1)
+    list_pred=np.array(pred_list).reshape(-1,1)
     data_out = np.concatenate((ids, list_pred), axis=1)
     df_out= pd.DataFrame(data_out, columns=tag)
     df_out.to_csv('pytorch_sub' + '.csv', sep=',', encoding='utf-8', index=False)
@@ -300,55 +544,60 @@ def data_out(out_list):
 ##																										 ##
 ###########################################################################################################
 
-def guidedBackProp(model):
-    loader = DataLoader(valset, batch_size=1,
-                        shuffle=True, num_workers=args.nworkers, **kwargs)
-    for i, (X,y) in enumerate(loader):
-        if cuda:
-            X, y ,model= X.cuda(), y.cuda(),model.cuda()
-        X, y = Variable(X,requires_grad=True), y
-        GBP = GuidedBackprop(model,  X, y)
-        # Get gradients
-        guided_grads = GBP.generate_gradients()
-        if i==10:
-            break
-        save_gradient_images(guided_grads, str(i)+'th_image_Guided_BP')
-    pass
-
-
-def fooling(model):
-    # setting a Target other than original label
-    target_y = np.random.randint(0,10)
-    loader = DataLoader(valset, batch_size=10,
+def guidedBackProp(model, n_images=10):
+    loader = DataLoader(valset, batch_size=n_images,
                         shuffle=True, num_workers=args.nworkers, **kwargs)
-    for i, (X,y) in enumerate(loader):
-        if cuda:
-            X, y ,model= X.cuda(), y.cuda(),model.cuda()
-        if i==10:
-            break
-        X_tensor = X
-        X_fooling = make_fooling_image(X_tensor[i:i + 1], target_y, model)
+    X, y = next(iter(loader))
+    if cuda:
+        X, y ,model= X.cuda(), y.cuda(),model.cuda()
+    # Get gradients of the whole batch with one backward pass
+    with GuidedBackprop(model) as GBP:
+        guided_grads = GBP.generate_gradients(utils.normalize_batch(X), y)
+    # one mosaic of all images instead of a file per image
+    save_gradient_mosaic(guided_grads, 'Guided_BP_{}_images'.format(len(guided_grads)))
+
 
-        scores = model(Variable(X_fooling))
-        ori_class=y[i:i + 1].cpu().numpy()[0]
-        X_fooling_out=X_fooling.cpu()
-        assert bool((ori_class != scores.data.max(1)[1]).cpu().numpy()[0]), 'for {}th input the model is not fooled!'.format(i)
-        save_fooling_images(X_fooling_out, str(i) + 'th_image_is_'+str(fashion_names[ori_class])+'_as_starting_image_classified_as'+str(fashion_names[scores.data.max(1)[1].cpu().numpy()[0]]))
+def fooling(model, n_images=10):
+    # a random target other than the original label for every image, all images are fooled in one batch
+    loader = DataLoader(valset, batch_size=n_images,
+                        shuffle=True, num_workers=args.nworkers, **kwargs)
+    X, y = next(iter(loader))
+    if cuda:
+        X, y ,model= X.cuda(), y.cuda(),model.cuda()
+    target_y = (y + torch.randint(1, 10, y.size(), device=y.device)) % 10
+    start = time.time()
+    X_fooling, fooled = make_fooling_images(utils.normalize_batch(X), target_y, model)
+    seconds = time.time() - start
+    print('fooling images: {} / {} fooled in {:.1f}s, {:.2f} images/sec'.format(
+        int(fooled.sum()), len(y), seconds, len(y) / seconds))
+
+    # checked in eval mode as make_fooling_images did, the model is given back in its mode
+    was_training = model.training
+    model.eval()
+    with torch.inference_mode():
+        pred = model(X_fooling).max(1)[1].cpu().numpy()
+    model.train(was_training)
+    X_fooling_out = X_fooling.cpu()
+    for i, ori_class in enumerate(y.cpu().numpy()):
+        if not fooled[i]:
+            print('for {}th input the model is not fooled!'.format(i))
+            continue
+        save_fooling_images(X_fooling_out[i:i + 1], str(i) + 'th_image_is_'+str(fashion_names[ori_class])+'_as_starting_image_classified_as'+str(fashion_names[pred[i]]))
 
 
 
 if __name__ == '__main__':
 
-    if args.model==1:
-        net = FashionMNISTNet()
-    elif args.model==2:
-        net = BasicFashionMNISTNet()
+    net = models[args.model]()
     net.apply(weights_init)
-    print(net)
+    if rank == 0:
+        print(net)
     criterion = torch.nn.CrossEntropyLoss()
 
     if cuda:
         net, criterion = net.cuda(), criterion.cuda()
+    if args.precision == 'bf16':
+        utils.batchnorm_fp32(net)
     # early stopping parameters
     patience = args.patience
     best_loss = 1e4
@@ -360,61 +609,183 @@ if __name__ == '__main__':
     # Change optimizer for finetuning
     optimizer = optim.Adam(net.parameters(),lr=args.lr, weight_decay=0.0005)
 
+    # where training starts: epoch, batch within it and the loss / correct count of the skipped batches
+    start_epoch, start_step, running = 0, 0, (0, 0)
+    rng_state = None
     if args.resume:
         if os.path.isfile(args.resume):
-            print("=> loading checkpoint '{}'".format(args.resume))
-            checkpoint = torch.load(args.resume)
-            args.start_epoch = checkpoint['epoch']
+            if rank == 0:
+                print("=> loading checkpoint '{}'".format(args.resume))
+            checkpoint = torch.load(args.resume, map_location='cpu')
+            start_epoch = checkpoint['epoch']
+            start_step = checkpoint.get('step', 0)
+            # the running totals of all ranks were summed when saving, rank 0 carries them on
+            running = checkpoint.get('running', running) if rank == 0 else running
             best_prec1 = checkpoint['best_prec1']
+            best_loss = checkpoint.get('best_loss', best_loss)
+            patience = checkpoint.get('patience', patience)
+            # a --world_size checkpoint holds the random state of every rank
+            rng_ranks = checkpoint.get('rng_ranks')
+            rng_state = rng_ranks[rank] if rng_ranks and len(rng_ranks) == world_size else checkpoint.get('rng')
+            if 'rank' in checkpoint:
+                # low rank checkpoint written by lowrank.py, it has new parameters and no optimizer state
+                net.classifier[checkpoint['layer']] = low_rank_shell(net.classifier[checkpoint['layer']], checkpoint['rank'])
+                net = net.cuda() if cuda else net
+                optimizer = optim.Adam(net.parameters(),lr=args.lr, weight_decay=0.0005)
             net.load_state_dict(checkpoint['state_dict'])
-            optimizer.load_state_dict(checkpoint['optimizer'])
-            print("=> loaded checkpoint '{}' (epoch {})"
-                  .format(args.resume, checkpoint['epoch']))
+            if 'optimizer' in checkpoint:
+                optimizer.load_state_dict(checkpoint['optimizer'])
+            if rank == 0:
+                print("=> loaded checkpoint '{}' (epoch {}, step {})"
+                      .format(args.resume, checkpoint['epoch'], start_step))
+            # saved by the epoch that ran out of patience, the uninterrupted run stopped there
+            if patience <= 0:
+                if rank == 0:
+                    print('Run out of patience!')
+                start_epoch, start_step = args.nepochs, 0
         else:
             print("=> no checkpoint found at '{}'".format(args.resume))
 
-    for e in range(args.nepochs):
-        start = time.time()
-        train_loss, train_acc = train(net, train_loader,
-            criterion, optimizer)
-        val_loss, val_acc = validate(net, val_loader, criterion)
-        end = time.time()
-
-        # print stats
-        stats ="""Epoch: {}\t train loss: {:.3f}, train acc: {:.3f}\t
-                val loss: {:.3f}, val acc: {:.3f}\t
-                time: {:.1f}s""".format( e, train_loss, train_acc, val_loss,
-                val_acc, end-start)
-        print(stats)
-        print(stats, file=logfile)
-        if best_prec1 < val_acc:
-            best_prec1=val_acc
-            predict(net, test_loader)
-        is_best_acc=best_prec1 > val_acc
-        #early stopping and save best model
-        if val_loss < best_loss:
-            best_loss = val_loss
-            patience = args.patience
-            # print(net.state_dict())
-            utils.save_model({
-                'epoch': e + 1,
-                'best_prec1': best_prec1,
-                'state_dict': net.state_dict(),
-                'optimizer': optimizer.state_dict(),
-            }, is_best_acc, 'saved-models/{}-run-{}.pth.tar'.format(args.model, run))
-        else:
-            patience -= 1
-            if patience == 0:
-                print('Run out of patience!')
+    if args.distill:
+        teacher = load_factorized(args.distill, args.teacher_model)
+        if cuda:
+            teacher = teacher.cuda()
+        # rank 0 computes and caches the logits, the other ranks wait and read the cache
+        if rank != 0:
+            dist.barrier()
+        logits = teacher_logits(teacher, trainset, args.distill)
+        if rank == 0 and world_size > 1:
+            dist.barrier()
+        del teacher
+        train_loader = make_train_loader(DistillDataset(trainset, logits))
+
+    # model is the bare network: checkpoints, predictions and plots use it, the training loop uses net
+    model = net
+    if world_size > 1:
+        net = DistributedDataParallel(model, device_ids=[local_rank] if cuda else None)
+
+    if args.bench_loader:
+        images_per_sec = utils.loader_throughput(train_loader)
+        if rank == 0:
+            print('train loader: {:.0f} images/sec'.format(images_per_sec))
+        print('train loader: {:.0f} images/sec'.format(images_per_sec), file=logfile)
+        if args.instrument:
+            # the benchmark batches must not count in the first loader.csv row
+            train_loader.dataset.stats.zero_()
+
+    # checkpoints are written by a background thread, see utils.CheckpointWriter
+    writer = utils.CheckpointWriter(keep=args.keep_checkpoints)
+    checkpoint_name = 'saved-models/{}-run-{}.pth.tar'.format(args.model, run)
+
+    def checkpoint_state(epoch, step=0, running=(0, 0), rng_ranks=None):
+        """
+        Everything needed to continue exactly: epoch (completed epochs), step (batches into the next one).
+        rng_ranks are the random states of all ranks of a --world_size run, see utils.gather_rng_state
+        """
+        state = {
+            'epoch': epoch,
+            'step': step,
+            'running': running,
+            'best_prec1': best_prec1,
+            'best_loss': best_loss,
+            'patience': patience,
+            'state_dict': model.state_dict(),
+            'optimizer': optimizer.state_dict(),
+            'rng': utils.get_rng_state(),
+        }
+        if rng_ranks is not None:
+            state['rng_ranks'] = rng_ranks
+        return state
+
+    # optional torch.profiler trace of a window of batches of the first epoch, written to the run folder
+    profiler = None
+    if args.profile_steps and rank == 0:
+        # profiler step i is batch i: batches before first_step - 1 are skipped, first_step - 1 is the warm up
+        profiler = torch.profiler.profile(
+            activities=[torch.profiler.ProfilerActivity.CPU] + ([torch.profiler.ProfilerActivity.CUDA] if cuda else []),
+            schedule=torch.profiler.schedule(wait=first_step - 1, warmup=1, active=last_step - first_step, repeat=1),
+            on_trace_ready=torch.profiler.tensorboard_trace_handler(current_dir),
+            record_shapes=True)
+        profiler.start()
+
+    def on_step(step, running):
+        if profiler is not None:
+            profiler.step()
+        if args.checkpoint_every and step % args.checkpoint_every == 0:
+            running = tuple(utils.all_reduce_sum(*running))
+            rng_ranks = utils.gather_rng_state()
+            if rank == 0:
+                writer.save(checkpoint_state(e, step, running, rng_ranks), False, checkpoint_name)
+
+    # restored last, everything above may have drawn random numbers
+    if rng_state is not None:
+        utils.set_rng_state(rng_state)
+
+    # the queued checkpoints are written even when training stops on an exception
+    try:
+        for e in range(start_epoch, args.nepochs):
+            start = time.time()
+            if args.stream_aug:
+                trainset.set_epoch(e)
+            train_loader.sampler.set_epoch(e, start_step * train_loader.batch_size)
+            timings = {}
+            train_loss, train_acc = train(net, train_loader,
+                criterion, optimizer, start_step, running, on_step, timings)
+            start_step, running = 0, (0, 0)
+            train_end = time.time()
+            # the bare model: the DDP wrapper broadcasts buffers on every forward and the ranks may have a
+            # different number of validation batches, the only collectives are the ones every rank makes
+            utils.broadcast_buffers(model)
+            val_loss, val_acc = validate(model, val_loader, criterion)
+            end = time.time()
+
+            # print stats
+            stats ="""Epoch: {}\t train loss: {:.3f}, train acc: {:.3f}\t
+                    val loss: {:.3f}, val acc: {:.3f}\t
+                    time: {:.1f}s, train {:.0f} images/sec ({}, {} processes)""".format( e, train_loss, train_acc, val_loss,
+                    val_acc, end-start, len(train_loader.dataset) / (train_end - start), args.precision, world_size)
+            stats += "\n                " + ", ".join("{} {:.0f}%".format(stage, 100. * seconds / (train_end - start))
+                                                      for stage, seconds in timings.items())
+            if rank == 0:
+                print(stats)
+                print(stats, file=logfile)
+                utils.log_timings('{}/timings.csv'.format(current_dir), e, timings, len(train_loader.dataset), train_end - start)
+                if args.instrument:
+                    utils.log_loader_stats('{}/loader.csv'.format(current_dir), e, train_loader.dataset)
+            if profiler is not None:
+                profiler.stop()
+                profiler = None
+            if best_prec1 < val_acc:
+                best_prec1=val_acc
+                if rank == 0:
+                    predict(model, test_loader)
+            is_best_acc=best_prec1 == val_acc # this epoch set the best accuracy
+            #early stopping
+            if val_loss < best_loss:
+                best_loss = val_loss
+                patience = args.patience
+            else:
+                patience -= 1
+            # every epoch is saved, so a resumed run continues from the last one with the same patience
+            rng_ranks = utils.gather_rng_state()
+            if rank == 0:
+                writer.save(checkpoint_state(e + 1, rng_ranks=rng_ranks), is_best_acc, checkpoint_name)
+            if patience <= 0:
+                if rank == 0:
+                    print('Run out of patience!')
                 break
+    finally:
+        writer.close()
+    if world_size > 1:
+        dist.destroy_process_group()
     # predict(net, test_loader)
 
     ###### IN case of Base CONFIG         #########################################################################
-    if args.model==2:
-        filter=net.state_dict()["features.0.weight"].cpu().numpy()
+    if args.model==2 and rank == 0:
+        filter=model.state_dict()["features.0.weight"].cpu().numpy()
         plotNNFilter(filter,"filter64")
-        guidedBackProp(net)
-        fooling(net)
+        guidedBackProp(model)
+        fooling(model)
     ##################################################################################################
 
 
@@ -1,30 +1,329 @@
 import torch
 import torch.nn as nn
+import torch.distributed as dist
 from PIL import Image
 import numpy as np
 import random
 import math
 import shutil
-from matplotlib import pyplot as plt
+import time
+import os
+import queue
+import threading
+import itertools
+import subprocess
+import sys
 
-def save_model(model_state, is_best_acc, filename):
-    """ Save model """
-    # TODO: add it as checkpoint
-    torch.save(model_state,filename)
+def link_atomic(src, dst):
+    """ dst becomes a hard link to src (a copy across file systems), replaced atomically """
+    tmp_path = dst + '.tmp'
+    if os.path.lexists(tmp_path):
+        os.remove(tmp_path)
+    try:
+        os.link(src, tmp_path)
+    except OSError:
+        shutil.copyfile(src, tmp_path)
+    os.replace(tmp_path, dst)
+
+
+def save_model(model_state, is_best_acc, filename, best_filename='model_best.pth.tar'):
+    """ Save model: written under a temporary name and renamed, the best model is a hard link to it """
+    tmp_path = filename + '.tmp'
+    torch.save(model_state, tmp_path)
+    os.replace(tmp_path, filename)
     if is_best_acc:
-        shutil.copyfile(filename, 'model_best.pth.tar')
+        link_atomic(filename, best_filename)
+
+
+def to_cpu(obj):
+    """ Copy of every tensor of a (nested) checkpoint dict on the cpu, later training steps cannot change it """
+    if torch.is_tensor(obj):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return type(obj)((k, to_cpu(v)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(to_cpu(v) for v in obj)
+    return obj
+
+
+class CheckpointWriter(object):
+    """
+    Saves checkpoints on a background thread so training does not wait for the disk.
+    save() snapshots the state to the cpu and returns, the thread writes <name>-epoch-<n>.pth.tar atomically,
+    points filename (latest) and best_filename at it through hard links and removes all but the last keep epochs.
+    Mid epoch snapshots (<name>-epoch-<n>-step-<s>.pth.tar) are rotated apart, only the newest one is kept.
+    At most one snapshot waits in the queue, a slow disk blocks save() instead of piling up model copies.
+    """
+
+    def __init__(self, keep=3, best_filename='model_best.pth.tar'):
+        self.keep = keep
+        self.best_filename = best_filename
+        self.written = []
+        self.steps = []
+        self.error = None
+        self.queue = queue.Queue(maxsize=1)
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def epoch_path(self, filename, epoch, step=0):
+        root, ext = (filename[:-8], '.pth.tar') if filename.endswith('.pth.tar') else os.path.splitext(filename)
+        if step:
+            return '{}-epoch-{}-step-{}{}'.format(root, epoch, step, ext)
+        return '{}-epoch-{}{}'.format(root, epoch, ext)
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                return
+            state, is_best_acc, filename = item
+            try:
+                path = self.epoch_path(filename, state.get('epoch', len(self.written)), state.get('step', 0))
+                save_model(state, False, path)
+                link_atomic(path, filename)
+                if is_best_acc:
+                    link_atomic(path, self.best_filename)
+                # step snapshots must not push the epoch checkpoints off the disk
+                written, keep = (self.steps, 1) if state.get('step', 0) else (self.written, self.keep)
+                if path not in written:
+                    written.append(path)
+                while len(written) > keep:
+                    old = written.pop(0)
+                    if os.path.exists(old):
+                        os.remove(old)
+            except Exception as e:
+                self.error = e
+            self.queue.task_done()
+
+    def check(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def save(self, model_state, is_best_acc, filename):
+        """ Same arguments as save_model, returns as soon as the state is copied to the cpu """
+        self.check()
+        self.queue.put((to_cpu(model_state), is_best_acc, filename))
+
+    def close(self):
+        """ Waits for the pending checkpoints """
+        self.queue.put(None)
+        self.thread.join()
+        self.check()
+
+
+def get_rng_state():
+    """
+    State of every random generator training draws from: dropout, batch augmentation, numpy, random.
+    Tensors and plain python values only, a checkpoint holding it still loads with weights_only=True
+    """
+    name, key, pos, has_gauss, cached_gaussian = np.random.get_state()
+    state = {'torch': torch.get_rng_state(),
+             'numpy': (name, torch.from_numpy(key.astype(np.int64)), int(pos), int(has_gauss), float(cached_gaussian)),
+             'python': random.getstate()}
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    torch.set_rng_state(state['torch'])
+    name, key, pos, has_gauss, cached_gaussian = state['numpy']
+    np.random.set_state((name, np.asarray(key, dtype=np.uint32), pos, has_gauss, cached_gaussian))
+    random.setstate(state['python'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+def gather_rng_state():
+    """ get_rng_state of every rank of a --world_size run, in rank order, None in a single process """
+    if not (dist.is_available() and dist.is_initialized()):
+        return None
+    states = [None] * dist.get_world_size()
+    dist.all_gather_object(states, get_rng_state())
+    return states
+
+
+class ResumableSampler(torch.utils.data.DistributedSampler):
+    """
+    Shuffled indices whose order depends only on (seed, epoch), so an epoch restarted from a checkpoint
+    sees the same batches. set_epoch(epoch, start) skips the first start indices of that epoch.
+    With num_replicas > 1 every rank gets its own shard of the epoch, as DistributedSampler does.
+    """
+
+    def __init__(self, data_source, seed=1, num_replicas=1, rank=0):
+        super().__init__(data_source, num_replicas=num_replicas, rank=rank, shuffle=True, seed=seed)
+        self.start = 0
+
+    def set_epoch(self, epoch, start=0):
+        super().set_epoch(epoch)
+        self.start = start
+
+    def __iter__(self):
+        return itertools.islice(super().__iter__(), self.start, None)
+
+    def __len__(self):
+        return self.num_samples - self.start
+
+
+class TimedDataset(object):
+    """
+    Counts the items served and the seconds spent in __getitem__ by every DataLoader worker.
+    The counters live in shared memory, each worker writes its own row, the main process reads them.
+    """
+
+    def __init__(self, dataset, num_workers):
+        self.dataset = dataset
+        self.stats = torch.zeros(max(num_workers, 1), 2, dtype=torch.float64).share_memory_()
+
+    def __getitem__(self, index):
+        start = time.perf_counter()
+        item = self.dataset[index]
+        info = torch.utils.data.get_worker_info()
+        row = self.stats[info.id if info is not None else 0]
+        row[0] += 1
+        row[1] += time.perf_counter() - start
+        return item
+
+    def __len__(self):
+        return len(self.dataset)
+
+
+def log_timings(path, epoch, timings, n_images, seconds):
+    """ One csv row per epoch: seconds of every training loop stage and images/sec """
+    stages = ['data', 'adv', 'forward', 'backward', 'step', 'other']
+    new = not os.path.exists(path)
+    with open(path, 'a') as f:
+        if new:
+            f.write(','.join(['epoch'] + stages + ['total', 'images_per_sec']) + '\n')
+        row = [epoch] + ['{:.3f}'.format(timings.get(stage, 0.)) for stage in stages]
+        f.write(','.join(str(v) for v in row + ['{:.3f}'.format(seconds), '{:.1f}'.format(n_images / seconds)]) + '\n')
+
+
+def log_loader_stats(path, epoch, dataset):
+    """ One csv row per worker and epoch from a TimedDataset, the counters are reset afterwards """
+    new = not os.path.exists(path)
+    with open(path, 'a') as f:
+        if new:
+            f.write('epoch,worker,items,busy_seconds,items_per_busy_sec\n')
+        for worker, (items, seconds) in enumerate(dataset.stats.tolist()):
+            f.write('{},{},{:.0f},{:.3f},{:.1f}\n'.format(epoch, worker, items, seconds, items / max(seconds, 1e-9)))
+    dataset.stats.zero_()
+
+
+def broadcast_buffers(net, src=0):
+    """ BatchNorm running statistics of rank src on every process, a no-op in a single process """
+    if not (dist.is_available() and dist.is_initialized()):
+        return
+    for buffer in net.buffers():
+        dist.broadcast(buffer, src)
+
+
+def all_reduce_sum(*values):
+    """ Sums of the numbers over all processes of a --world_size run, the numbers themselves in a single process """
+    if not (dist.is_available() and dist.is_initialized()):
+        return values
+    total = torch.tensor(values, dtype=torch.float64)
+    dist.all_reduce(total)
+    return total.tolist()
+
+
+def launch(world_size, nnodes=1, node_rank=0, master_addr='127.0.0.1', master_port=29500):
+    """
+    Runs this script again once per local rank with the environment torchrun would set (RANK, LOCAL_RANK,
+    WORLD_SIZE, LOCAL_WORLD_SIZE, MASTER_ADDR, MASTER_PORT), the processes meet with the env:// rendezvous.
+    On several nodes every node runs the same command with its own node_rank and master_addr of node 0.
+    A failed rank stops the others, they would wait for it forever. Returns the exit code of the job.
+    """
+    nproc = world_size // nnodes
+    env = dict(os.environ, WORLD_SIZE=str(world_size), LOCAL_WORLD_SIZE=str(nproc),
+               MASTER_ADDR=master_addr, MASTER_PORT=str(master_port))
+    procs = [subprocess.Popen([sys.executable] + sys.argv,
+                              env=dict(env, RANK=str(node_rank * nproc + r), LOCAL_RANK=str(r)))
+             for r in range(nproc)]
+    try:
+        while any(p.poll() is None for p in procs):
+            if any(p.poll() for p in procs):
+                break
+            time.sleep(0.5)
+    finally:
+        for p in procs:
+            if p.poll() is None:
+                p.terminate()
+    return max(abs(p.wait()) for p in procs)
+
+
+def normalize_batch(X, mean=0.1307, std=0.3081):
+    """ uint8 image batch to the normalized float batch ToTensor + Normalize would give """
+    return (X.float().div_(255.) - mean) / std
+
+
+def batchnorm_fp32(net):
+    """ Keep every BatchNorm of net in fp32 under bf16 autocast: its input is cast back to float """
+    for m in net.modules():
+        if isinstance(m, nn.modules.batchnorm._BatchNorm):
+            m.register_forward_pre_hook(lambda module, inputs: tuple(x.float() for x in inputs))
+    return net
+
+
+def loader_throughput(loader):
+    """ Images per second served by one pass over the loader """
+    start = time.time()
+    n = 0
+    for batch in loader:
+        X = batch[0] if isinstance(batch, (list, tuple)) else batch
+        n += normalize_batch(X).size(0)
+    return n / (time.time() - start)
+
+
+def make_mosaic(tiles, n_columns=8, padding=1, normalize='each', pad_value=1.):
+    """
+    Tile a stack of 2-D maps (filters, feature maps, gradients) into one image
+    Args:
+        tiles (np arr): (N, H, W)
+        n_columns (int): tiles per row
+        padding (int): pixels between tiles
+        normalize (string): 'each' scales every tile to [0, 1] on its own, 'all' uses one range for the stack
+        pad_value (float): value of the padding and of empty tiles, in [0, 1]
+    Returns:
+        np arr: float (rows * (H + padding) - padding, n_columns * (W + padding) - padding) in [0, 1]
+    """
+    tiles = np.asarray(tiles, dtype=np.float32)
+    N, H, W = tiles.shape
+    axes = (1, 2) if normalize == 'each' else None
+    low = tiles.min(axis=axes, keepdims=True)
+    span = tiles.max(axis=axes, keepdims=True) - low
+    tiles = (tiles - low) / np.where(span > 0, span, 1.)
+
+    n_columns = min(n_columns, N)
+    n_rows = -(-N // n_columns)
+    grid = np.full((n_rows * n_columns, H + padding, W + padding), pad_value, dtype=np.float32)
+    grid[:N, :H, :W] = tiles
+    grid = grid.reshape(n_rows, n_columns, H + padding, W + padding).transpose(0, 2, 1, 3)
+    grid = grid.reshape(n_rows * (H + padding), n_columns * (W + padding))
+    return grid[:grid.shape[0] - padding, :grid.shape[1] - padding] if padding else grid
 
 
-def plotNNFilter(units,fname):
-    filters = units.shape[0]
-    fig=plt.figure(1, figsize=(80,80))
-    n_columns = 8
-    n_rows = math.ceil(filters / n_columns) + 1
-    for i in range(filters):
-        ax=fig.add_subplot(n_rows, n_columns, i+1)
-        data=units[i,:].reshape(3,3)
-        ax.imshow(data, interpolation="nearest", cmap="gray")
-        fig.savefig(fname+'.png')
+def save_mosaic(mosaic, fname, scale=16):
+    """ One grayscale PNG of a [0, 1] mosaic, every value scale x scale pixels (nearest neighbour) """
+    img = np.uint8(np.round(mosaic * 255.))
+    img = img.repeat(scale, axis=0).repeat(scale, axis=1)
+    Image.fromarray(img, mode='L').save(fname + '.png')
+
+
+def plotNNFilter(units,fname, n_columns=8, scale=16):
+    """
+    All filters of a conv weight (F, C, kh, kw) in one PNG: one tile per filter and input channel,
+    a row per filter when C > 1. Feature maps (C, H, W) of one image are drawn the same way.
+    """
+    units = np.asarray(units)
+    if units.ndim == 4:
+        F, C = units.shape[:2]
+        n_columns = C if C > 1 else n_columns
+        units = units.reshape(F * C, units.shape[2], units.shape[3])
+    save_mosaic(make_mosaic(units, n_columns), fname, scale)
+
 
 class RandomVerticalFlip(object):
     """Horizontally flip the given PIL.Image randomly with a probability of 0.5."""
@@ -106,4 +405,117 @@ class RandomErasing(object):
             img[x1:x1 + h, y1:y1 + w] = self.mean[1]
 
         img = Image.fromarray(img.astype("uint8"))
-        return img
\ No newline at end of file
+        return img
+
+###### Batch level augmentation, applied to a collated (N, C, H, W) tensor with per sample randomness
+
+class BatchCompose(object):
+    """Applies a list of batch transforms in order."""
+
+    def __init__(self, transforms):
+        self.transforms = transforms
+
+    def __call__(self, X):
+        for t in self.transforms:
+            X = t(X)
+        return X
+
+
+class BatchRandomVerticalFlip(object):
+    """Vertically flip every image of the batch with a probability of 0.5."""
+
+    def __call__(self, X):
+        """
+        Args:
+            X (Tensor): Batch (N, C, H, W) to be flipped.
+        Returns:
+            Tensor: Batch with randomly flipped images.
+        """
+        flip = (torch.rand(X.size(0), device=X.device) < 0.5).view(-1, 1, 1, 1)
+        return torch.where(flip, X.flip(2), X)
+
+
+class BatchRandomHorizontalFlip(object):
+    """Horizontally flip every image of the batch with a probability of 0.5."""
+
+    def __call__(self, X):
+        flip = (torch.rand(X.size(0), device=X.device) < 0.5).view(-1, 1, 1, 1)
+        return torch.where(flip, X.flip(3), X)
+
+
+class BatchRandomRotation(object):
+    """Rotate every image of the batch (90/180 degrees, counter clockwise) with a probability of 0.5."""
+
+    def __call__(self, X):
+        """
+        Args:
+            X (Tensor): Batch (N, C, H, W) of square images to be rotated.
+        Returns:
+            Tensor: Batch with randomly rotated images.
+        """
+        rotate = torch.rand(X.size(0), device=X.device) < 0.5
+        k = torch.randint(1, 3, (X.size(0),), device=X.device)
+        for quarter in (1, 2):
+            sel = (rotate & (k == quarter)).view(-1, 1, 1, 1)
+            X = torch.where(sel, torch.rot90(X, quarter, (2, 3)), X)
+        return X
+
+
+class BatchRandomTranslation(object):
+    """Translates every image of the batch randomly (0-10 pixels) with a probability of 0.5, borders filled with 0."""
+
+    def __init__(self, max_vshift=10, max_hshift=10):
+        self.max_vshift = max_vshift
+        self.max_hshift = max_hshift
+
+    def __call__(self, X):
+        """
+        Args:
+            X (Tensor): Batch (N, C, H, W) to be translated.
+        Returns:
+            Tensor: Batch with randomly translated images, out[r, c] = in[r + vshift, c + hshift].
+        """
+        N, C, H, W = X.size()
+        shift = torch.rand(N, device=X.device) < 0.5
+        hshift = torch.randint(-self.max_hshift, self.max_hshift, (N,), device=X.device) * shift
+        vshift = torch.randint(-self.max_vshift, self.max_vshift, (N,), device=X.device) * shift
+        rows = torch.arange(H, device=X.device).view(1, H) + vshift.view(N, 1)
+        cols = torch.arange(W, device=X.device).view(1, W) + hshift.view(N, 1)
+        valid = ((rows >= 0) & (rows < H)).view(N, 1, H, 1) & ((cols >= 0) & (cols < W)).view(N, 1, 1, W)
+        n = torch.arange(N, device=X.device).view(N, 1, 1)
+        # (N, H, W, C) gather of the shifted pixels, then back to (N, C, H, W)
+        out = X[n, :, rows.clamp(0, H - 1).view(N, H, 1), cols.clamp(0, W - 1).view(N, 1, W)].permute(0, 3, 1, 2)
+        return torch.where(valid, out, torch.zeros_like(out))
+
+
+###### Help From https://arxiv.org/abs/1708.04896
+
+class BatchRandomErasing(object):
+    """Erases a random rectangle of every image of the batch with a probability of EPSILON."""
+
+    def __init__(self, EPSILON=0.5, sl=0.02, sh=0.4, r1=0.3, value=0):
+        self.EPSILON = EPSILON
+        self.value = value
+        self.sl = sl
+        self.sh = sh
+        self.r1 = r1
+
+    def __call__(self, X):
+        N, C, H, W = X.size()
+        area = H * W
+        target_area = torch.empty(N, device=X.device).uniform_(self.sl, self.sh) * area
+        aspect_ratio = torch.empty(N, device=X.device).uniform_(self.r1, 1 / self.r1)
+
+        h = torch.round(torch.sqrt(target_area * aspect_ratio)).long()
+        w = torch.round(torch.sqrt(target_area / aspect_ratio)).long()
+        erase = (torch.rand(N, device=X.device) < self.EPSILON) & (w < W) & (h < W)
+
+        # top left corner uniform in [0, H - h] x [0, W - w]
+        x1 = (torch.rand(N, device=X.device) * (H - h + 1).clamp(min=1).float()).long()
+        y1 = (torch.rand(N, device=X.device) * (W - w + 1).clamp(min=1).float()).long()
+        rows = torch.arange(H, device=X.device).view(1, H)
+        cols = torch.arange(W, device=X.device).view(1, W)
+        in_rows = (rows >= x1.view(N, 1)) & (rows < (x1 + h).view(N, 1))
+        in_cols = (cols >= y1.view(N, 1)) & (cols < (y1 + w).view(N, 1))
+        mask = (in_rows.view(N, 1, H, 1) & in_cols.view(N, 1, 1, W)) & erase.view(N, 1, 1, 1)
+        return X.masked_fill(mask, self.value)
@@ -1,4 +1,5 @@
 import os
+import sys
 import math
 import time
 import math
@@ -12,6 +13,9 @@ from pdb import set_trace as bp
 from sklearn.manifold import TSNE
 from mpl_toolkits.axes_grid1 import ImageGrid
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from datacache import load_csv
+
 parser = argparse.ArgumentParser(description='Restricted Boltzman Machine')
 parser.add_argument("--lr", type=float, default=0.1, help="initial learning rate for gradient descent based algorithms")
 
@@ -255,13 +259,9 @@ def random_mini_batches(X, mini_batch_size=64, seed=0):
 
 
 print("Loading Data...")
-train = pd.read_csv(args.train)
-test = pd.read_csv(args.test)
-
-train_x = np.array(train.drop(columns=["label"], axis=1))
+train_x, _ = load_csv(args.train, drop=())
 train_x = (train_x > 126) * 1
-test_x = np.array(test.drop(columns=["label"], axis=1))
+test_x, test_y = load_csv(args.test, drop=())
 test_x = (test_x > 126) * 1
-test_y = test["label"]
 
 test_rbm(train_x, testdata=test_x, test_y=test_y, k=args.k, training_epochs=args.epochs)
@@ -0,0 +1,74 @@
+"""
+Binary cache for the 784 pixel Fashion-MNIST csv files used by A1, A3 and A5.
+
+The first load of a csv converts it into a uint8 pixel file (N, 784) and an int64 label file (N,),
+both plain .npy files. Later loads memory map them, so start up costs milliseconds instead of a
+pd.read_csv, and forked DataLoader workers share the same pages.
+Cache entries are keyed by the csv path, size and mtime, so an edited csv is converted again.
+"""
+import os
+import sys
+import time
+import hashlib
+import numpy as np
+import pandas as pd
+
+CACHE_DIR = os.environ.get("DATACACHE_DIR", "")
+
+
+def cache_paths(csv_path, label, drop, cache_dir=CACHE_DIR):
+    stat = os.stat(csv_path)
+    key = "{}|{}|{}|{}|{}".format(os.path.abspath(csv_path), stat.st_size, stat.st_mtime_ns, label, ",".join(drop))
+    digest = hashlib.sha1(key.encode("utf-8")).hexdigest()[:16]
+    if not cache_dir:
+        cache_dir = os.path.join(os.path.dirname(os.path.abspath(csv_path)), ".datacache")
+    name = "{}-{}".format(os.path.splitext(os.path.basename(csv_path))[0], digest)
+    return os.path.join(cache_dir, name + ".pixels.npy"), os.path.join(cache_dir, name + ".labels.npy")
+
+
+def save_atomic(path, array):
+    """ np.save to a temporary file and rename it, so a reader never sees a half written cache """
+    tmp_path = "{}.{}.tmp".format(path, os.getpid())
+    with open(tmp_path, "wb") as f:
+        np.save(f, array)
+    os.replace(tmp_path, path)
+
+
+def convert_csv(csv_path, label, drop, pixels_path, labels_path):
+    data = pd.read_csv(csv_path)
+    columns = [c for c in data.columns if c != label and c not in drop]
+    pixels = np.ascontiguousarray(data[columns].values, dtype=np.uint8)
+    os.makedirs(os.path.dirname(pixels_path), exist_ok=True)
+    if label is not None:
+        save_atomic(labels_path, np.ascontiguousarray(data[label].values, dtype=np.int64))
+    save_atomic(pixels_path, pixels)
+
+
+def load_csv(csv_path, label="label", drop=("id",), cache_dir=CACHE_DIR):
+    """
+    Pixels and labels of a csv, memory mapped from the binary cache
+    Args:
+        csv_path (string): path to csv file
+        label (string): name of the label column, None for unlabelled data
+        drop (tuple): names of other non pixel columns, e.g. id
+    Returns:
+        pixels: uint8 array (N, 784)
+        labels: int64 array (N,), None if label is None
+    """
+    drop = tuple(c for c in drop if c != label)
+    pixels_path, labels_path = cache_paths(csv_path, label, drop, cache_dir)
+    if not os.path.exists(pixels_path):
+        convert_csv(csv_path, label, drop, pixels_path, labels_path)
+    # copy-on-write mapping: pages are shared between processes and writes never reach the cache file
+    pixels = np.load(pixels_path, mmap_mode="c")
+    labels = np.load(labels_path, mmap_mode="c") if label is not None else None
+    return pixels, labels
+
+
+if __name__ == '__main__':
+    # python datacache.py data/train.csv data/val.csv ... converts the files ahead of time
+    for csv_path in sys.argv[1:]:
+        start = time.time()
+        header = pd.read_csv(csv_path, nrows=0).columns
+        pixels, labels = load_csv(csv_path, label="label" if "label" in header else None)
+        print("{}: {} images, {:.3f}s".format(csv_path, pixels.shape[0], time.time() - start))